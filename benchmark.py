@@ -0,0 +1,236 @@
+""" Measures how the dataset functions in data.py scale with catalog size.
+
+For every scale a synthetic catalog is generated (see generate_dataset.py),
+then the parse time, the peak memory of parsing and the latency of every
+query in QUERIES are recorded.
+
+Usage: python benchmark.py [--scales 1000 10000 ...] [--output results.json]
+                           [--baseline old_results.json]
+                           [--parse-processes 4]
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+import data
+import generate_dataset
+
+DEFAULT_SCALES = [10 ** 3, 10 ** 4, 10 ** 5]
+
+#   A query is slower than the baseline if it takes this many times longer
+REGRESSION_THRESHOLD = 1.25
+
+
+class Query(NamedTuple):
+    """ A function to benchmark and the kind of argument it receives. """
+    function: Callable[[data.Dataset, str], object]
+    argument: str   # A key of the dictionary returned by make_arguments
+
+
+QUERIES: Dict[str, Query] = {
+    'get_albums': Query(lambda x, y: data.get_albums(x), 'none'),
+    'get_songs_in': Query(data.get_songs_in, 'album'),
+    'get_song_length': Query(data.get_song_length, 'song'),
+    'get_song_lyrics': Query(data.get_song_lyrics, 'song'),
+    'get_song_album': Query(data.get_song_album, 'song'),
+    'search_song_by_name': Query(data.search_song_by_name, 'name_word'),
+    'search_song_by_lyrics': Query(data.search_song_by_lyrics,
+                                   'lyrics_word'),
+    'search_lyrics_query': Query(data.search_lyrics_query, 'lyrics_query'),
+    'search_lyrics_phrase': Query(data.search_lyrics_query,
+                                  'lyrics_phrase'),
+    'complete_song_name': Query(data.complete_song_name, 'song_prefix'),
+    'complete_album_name': Query(data.complete_album_name, 'album_prefix'),
+    'search_song_by_length': Query(
+        lambda x, y: data.search_song_by_length(x, y, y + 0.1), 'length'),
+    'get_longest_songs': Query(
+        lambda x, y: data.get_longest_songs(x, 10), 'none'),
+    'get_longest_songs_in_album': Query(
+        lambda x, y: data.get_longest_songs(x, 10, y), 'album'),
+    'get_album_stats': Query(data.get_album_stats, 'album'),
+    'get_top_words': Query(lambda x, y: data.get_top_words(x, 10), 'none'),
+    'get_top_words_in_album': Query(
+        lambda x, y: data.get_top_words(x, 10, y), 'album'),
+    'get_similar_songs': Query(
+        lambda x, y: data.get_similar_songs(x, 10, y), 'song'),
+}
+
+
+def make_arguments(dataset: data.Dataset, vocabulary_words: List[str],
+                   count: int, rand: random.Random) -> Dict[str, List[str]]:
+    """ Random arguments for every kind of query argument.
+    :param dataset: The dataset the queries will run on.
+    :param vocabulary_words: Words the lyrics were generated from.
+    :param count: Number of arguments of each kind.
+    :return: A dictionary from argument kind to the arguments.
+    """
+    song_names = rand.sample(list(dataset.songs.keys()),
+                             min(count, len(dataset.songs)))
+    album_names = rand.sample(list(dataset.albums.keys()),
+                              min(count, len(dataset.albums)))
+    name_words = [rand.choice(name.split()) for name in song_names]
+    #   Phrases that appear in the songs, across lines too
+    song_words = [data.split_words(dataset.songs[name].lyrics)
+                  for name in song_names]
+    phrases = ['"{}"'.format(' '.join(words[:3])) for words in song_words]
+    lyrics_words = [word.lower() for word in
+                    rand.sample(vocabulary_words,
+                                min(count, len(vocabulary_words)))]
+    return {
+        'song': song_names,
+        'album': album_names,
+        'song_prefix': [name[:3] for name in song_names],
+        'album_prefix': [name[:3] for name in album_names],
+        'name_word': name_words,
+        'lyrics_word': lyrics_words,
+        #   Quoted, as the vocabulary has the words and, or and not too
+        'lyrics_query': ['"{}" and "{}" or not "{}"'.format(
+            *rand.sample(lyrics_words, 3)) for _ in range(count)],
+        'lyrics_phrase': phrases,
+        'length': [rand.uniform(1, 10) for _ in range(count)],
+        'none': [''] * count,
+    }
+
+
+def time_query(query: Query, dataset: data.Dataset,
+               arguments: List[str]) -> Dict[str, float]:
+    """ Runs a query with every argument and measures the latencies.
+    Lazy results (generators) are consumed, as the server would.
+    :return: Median, 95th percentile and max latency in microseconds.
+    """
+    latencies = []
+    for argument in arguments:
+        start = time.perf_counter()
+        result = query.function(dataset, argument)
+        if result is not None and not isinstance(result, (str, float)):
+            list(result)
+        latencies.append((time.perf_counter() - start) * 1_000_000)
+
+    latencies.sort()
+    return {
+        'median_us': statistics.median(latencies),
+        'p95_us': latencies[int(len(latencies) * 0.95)],
+        'max_us': latencies[-1],
+    }
+
+
+def benchmark_scale(song_count: int, vocabulary: generate_dataset.Vocabulary,
+                    query_count: int, max_lines: int,
+                    parse_processes: int = 1) -> Dict:
+    """ Generates a catalog with song_count songs and benchmarks it.
+    :param parse_processes: As in data.parse_dataset.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'dataset.txt')
+        with open(path, 'w') as file:
+            generate_dataset.write_dataset(file, song_count, vocabulary,
+                                           max_lines=max_lines)
+        with open(path, 'r') as file:
+            text = file.read()
+
+    start = time.perf_counter()
+    dataset = data.parse_dataset(text, parse_processes)
+    parse_seconds = time.perf_counter() - start
+
+    #   Parse again under tracemalloc, it slows down the parse time
+    del dataset
+    tracemalloc.start()
+    dataset = data.parse_dataset(text, parse_processes)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rand = random.Random(song_count)
+    arguments = make_arguments(dataset, vocabulary.words, query_count, rand)
+    queries = {name: time_query(query, dataset, arguments[query.argument])
+               for name, query in QUERIES.items()}
+
+    return {
+        'songs': song_count,
+        'text_bytes': len(text),
+        'parse_processes': parse_processes,
+        'parse_seconds': parse_seconds,
+        'peak_memory_bytes': peak_memory,
+        'queries': queries,
+    }
+
+
+def print_results(results: List[Dict],
+                  baseline: Optional[List[Dict]] = None) -> None:
+    """ Prints the results as a table.
+    If a baseline is given, every value is compared to it and
+    regressions are marked.
+    """
+    baseline_by_scale = {result['songs']: result for result in baseline or []}
+
+    def compare(value: float, old_value: Optional[float]) -> str:
+        if old_value is None or old_value == 0:
+            return ''
+        ratio = value / old_value
+        mark = ' REGRESSION' if ratio > REGRESSION_THRESHOLD else ''
+        return ' (x{:.2f}{})'.format(ratio, mark)
+
+    for result in results:
+        old = baseline_by_scale.get(result['songs'], {})
+        print('{:,} songs ({:,} bytes)'.format(result['songs'],
+                                               result['text_bytes']))
+        print('  parse ({} processes): {:.3f}s{}'.format(
+            result.get('parse_processes', 1), result['parse_seconds'],
+            compare(result['parse_seconds'], old.get('parse_seconds'))))
+        print('  peak memory: {:.1f}MB{}'.format(
+            result['peak_memory_bytes'] / 2 ** 20,
+            compare(result['peak_memory_bytes'],
+                    old.get('peak_memory_bytes'))))
+        for name, latency in result['queries'].items():
+            old_latency = old.get('queries', {}).get(name, {})
+            print('  {:<28} median {:>12.1f}us  p95 {:>12.1f}us{}'.format(
+                name, latency['median_us'], latency['p95_us'],
+                compare(latency['median_us'], old_latency.get('median_us'))))
+        print('')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', type=int, nargs='+',
+                        default=DEFAULT_SCALES,
+                        help='Numbers of songs to benchmark (up to 10^7)')
+    parser.add_argument('--queries', type=int, default=100,
+                        help='Number of times each query is run')
+    parser.add_argument('--max-lines', type=int, default=20,
+                        help='Maximum number of lyrics lines in a song')
+    parser.add_argument('--parse-processes', type=int, default=1,
+                        help='Parse in this many processes (compare to a '
+                             'baseline parsed in one)')
+    parser.add_argument('--output', help='Save the results as json')
+    parser.add_argument('--baseline',
+                        help='Results of a previous run to compare against')
+    args = parser.parse_args()
+
+    vocabulary = generate_dataset.load_vocabulary()
+    results = []
+    for scale in args.scales:
+        print('Benchmarking {:,} songs...'.format(scale))
+        results.append(benchmark_scale(scale, vocabulary,
+                                       args.queries, args.max_lines,
+                                       args.parse_processes))
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+
+    print('')
+    print_results(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+""" Records the requests the server receives, to replay them later with
+replay.py.
+
+A capture file is gzipped json lines, one request per line:
+    [time, session, code, data]
+or [time, session, code, data, catalog] for requests that name a catalog.
+time is in seconds since the epoch, session identifies the connection the
+request came from. Logins are not recorded.
+"""
+from json import loads as from_json, dumps as to_json
+from typing import Dict, List, NamedTuple, Optional
+import gzip
+import heapq
+import threading
+import time
+
+#   Requests kept in memory before they are written to the file
+FLUSH_COUNT = 1000
+#   Seconds requests may be kept in memory before they are written
+FLUSH_SECONDS = 5
+
+
+class CapturedRequest(NamedTuple):
+    """ A request read from a capture file. """
+    time: float
+    session: str
+    code: str
+    data: str
+    catalog: Optional[str]
+
+
+class Capture:
+    """ Records requests to a capture file, in batches. Thread safe.
+        Does nothing until opened.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file = None
+        self.lines: List[str] = []
+        self.flush_time = 0.0
+
+    def open(self, path: str) -> None:
+        """ Starts recording to a file. An existing file is appended to. """
+        with self.lock:
+            self.file = gzip.open(path, 'at')
+            self.flush_time = time.monotonic() + FLUSH_SECONDS
+
+    def record(self, session: str, request: Dict[str, str]) -> None:
+        """ Records a request, if recording.
+        :param session: Identifies the connection of the request.
+        :param request: As returned by helper.parse_message.
+        """
+        if self.file is None:
+            return
+
+        fields = [round(time.time(), 3), session,
+                  request.get('code'), request.get('data')]
+        if 'catalog' in request:
+            fields.append(request['catalog'])
+        line = to_json(fields, separators=(',', ':'))
+
+        with self.lock:
+            self.lines.append(line)
+            if (len(self.lines) >= FLUSH_COUNT or
+                    time.monotonic() >= self.flush_time):
+                self.flush()
+
+    def flush(self) -> None:
+        """ Writes the recorded requests. Call with the lock held. """
+        if self.file is not None and self.lines:
+            self.file.write('\n'.join(self.lines) + '\n')
+            self.file.flush()
+        self.lines.clear()
+        self.flush_time = time.monotonic() + FLUSH_SECONDS
+
+    def close(self) -> None:
+        with self.lock:
+            self.flush()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_capture(path: str) -> List[CapturedRequest]:
+    """ Reads the requests in a capture file, in the order they arrived. """
+    requests = []
+    with gzip.open(path, 'rt') as file:
+        try:
+            for line in file:
+                fields = from_json(line)
+                if len(fields) == 4:
+                    fields.append(None)
+                requests.append(CapturedRequest(*fields))
+        except EOFError:
+            #   The server was killed, what was flushed is still readable
+            pass
+    #   Session threads may record out of order by a few microseconds
+    requests.sort(key=lambda request: request.time)
+    return requests
+
+
+def read_captures(paths: List[str]) -> List[CapturedRequest]:
+    """ Reads capture files, like the files of different worker processes,
+        merged by time.
+    """
+    return list(heapq.merge(*(read_capture(path) for path in paths),
+                            key=lambda request: request.time))
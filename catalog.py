@@ -0,0 +1,184 @@
+""" Datasets loaded from files that can be changed while the server runs.
+
+Every change is appended to a journal file next to the dataset file
+(see journal_path), and the journal is replayed when the dataset is loaded.
+Server processes that share a dataset file also pick up each other's
+changes from the journal.
+
+A CatalogStore holds many catalogs, loads them on first use and unloads
+the least recently used ones to stay within a memory budget.
+
+Every state of a catalog has a version, which clients use to tell whether
+the responses they cached are still up to date.
+"""
+from collections import OrderedDict
+from json import loads as from_json, dumps as to_json
+from typing import Dict, List, Optional
+import hashlib
+import os
+import threading
+
+import data
+
+#   Memory used by a loaded catalog per byte of its files (the text and
+#   its indexes), as measured with benchmark.py
+MEMORY_PER_FILE_BYTE = 45
+
+
+def journal_path(dataset_path: str) -> str:
+    """ Where the changes to a dataset file are journaled. """
+    return os.path.splitext(dataset_path)[0] + '.journal'
+
+
+class Catalog:
+    """ A dataset, the lock that guards it and its journal.
+    Hold the lock (with catalog.lock) while reading the dataset.
+    """
+
+    def __init__(self, dataset_path: str, parse_processes: int = 1):
+        """ Loads the dataset and replays its journal.
+        :param parse_processes: Parse the dataset in this many processes.
+        """
+        self.dataset_path = dataset_path
+        self.journal_path = journal_path(dataset_path)
+        self.lock = threading.RLock()
+        #   How much of the journal was applied to the dataset
+        self.journal_offset = 0
+
+        dataset_stat = os.stat(dataset_path)
+        #   Identifies the dataset file, so catalogs (and different copies
+        #   of a file) never share versions
+        self.file_id = '{}:{}:{}'.format(os.path.abspath(dataset_path),
+                                         dataset_stat.st_mtime_ns,
+                                         dataset_stat.st_size)
+        with open(dataset_path, 'r') as file:
+            self.dataset = data.parse_dataset(file.read(), parse_processes)
+        self.update_version()
+        self.sync()
+
+    def memory_estimate(self) -> int:
+        """ Roughly how many bytes the loaded catalog takes. """
+        file_size = os.path.getsize(self.dataset_path) + self.journal_offset
+        return file_size * MEMORY_PER_FILE_BYTE
+
+    def update_version(self) -> None:
+        """ Sets the version of the dataset after it changed. Processes
+            that applied the same journal get the same version.
+        """
+        version_id = '{}:{}'.format(self.file_id, self.journal_offset)
+        self.version = hashlib.md5(version_id.encode()).hexdigest()[:16]
+
+    def sync(self) -> None:
+        """ Applies changes that were journaled by other processes. """
+        with self.lock:
+            try:
+                size = os.stat(self.journal_path).st_size
+            except FileNotFoundError:
+                return
+            if size == self.journal_offset:
+                return
+
+            with open(self.journal_path, 'rb') as journal:
+                journal.seek(self.journal_offset)
+                text = journal.read()
+            #   Another process may be in the middle of writing a line
+            end = text.rfind(b'\n') + 1
+            self.replay(text[:end].decode())
+            self.journal_offset += end
+            self.update_version()
+
+    def replay(self, journal_text: str) -> None:
+        """ Applies the changes in part of the journal. """
+        for line in journal_text.splitlines():
+            change = from_json(line)
+            try:
+                data.apply_change(self.dataset, change)
+            except data.ChangeError as e:
+                print('Skipping journaled change {}: {}'.format(change, e))
+
+    def change(self, change: Dict) -> None:
+        """ Applies a change to the dataset and journals it.
+        :param change: As in data.apply_change.
+        :throws: data.ChangeError, and nothing is journaled.
+        """
+        with self.lock, open(self.journal_path, 'ab') as journal:
+            #   Other processes must not append between the sync and the
+            #   write, or this change might conflict with theirs
+            with data.lock_file(journal):
+                self.sync()
+                data.apply_change(self.dataset, change)
+
+                journal.write((to_json(change) + '\n').encode())
+                journal.flush()
+                os.fsync(journal.fileno())
+                self.journal_offset = journal.tell()
+                self.update_version()
+
+
+class CatalogStore:
+    """ Catalogs by name, loaded on first use. When the loaded catalogs take
+        more than the memory budget, the least recently used are unloaded.
+        Changes are journaled, so unloading never loses them. Thread safe.
+    """
+
+    def __init__(self, dataset_paths: Dict[str, str], memory_budget: int,
+                 parse_processes: int = 1):
+        """
+        :param dataset_paths: The dataset file of every catalog, by name.
+        :param memory_budget: Bytes the loaded catalogs may take, estimated
+                              with Catalog.memory_estimate.
+        :param parse_processes: Parse every catalog in this many processes.
+        """
+        self.dataset_paths = dataset_paths
+        self.memory_budget = memory_budget
+        self.parse_processes = parse_processes
+        self.lock = threading.Lock()
+        #   Least recently used first
+        self.loaded: OrderedDict = OrderedDict()
+        #   Only one thread loads a catalog, others wait for it
+        self.loading_locks = {name: threading.Lock()
+                              for name in dataset_paths}
+
+    def names(self) -> List[str]:
+        return sorted(self.dataset_paths)
+
+    def get(self, name: str) -> Optional[Catalog]:
+        """ The catalog with this name, loaded if needed.
+        :return: None if there is no such catalog.
+        """
+        if name not in self.dataset_paths:
+            return None
+
+        with self.lock:
+            catalog = self.loaded.get(name)
+            if catalog is not None:
+                self.loaded.move_to_end(name)
+                return catalog
+
+        with self.loading_locks[name]:
+            with self.lock:
+                catalog = self.loaded.get(name)
+            if catalog is None:
+                print('Loading catalog {}'.format(name))
+                catalog = Catalog(self.dataset_paths[name],
+                                  self.parse_processes)
+
+            with self.lock:
+                self.loaded[name] = catalog
+                self.loaded.move_to_end(name)
+                self.evict(keep=name)
+            return catalog
+
+    def evict(self, keep: str) -> None:
+        """ Unloads the least recently used catalogs until the loaded
+            catalogs fit in the memory budget. Call with the lock held.
+        :param keep: A catalog not to unload, the one that is being used.
+        """
+        total = sum(catalog.memory_estimate()
+                    for catalog in self.loaded.values())
+        for name in list(self.loaded):
+            if total <= self.memory_budget:
+                break
+            if name != keep:
+                print('Unloading catalog {}'.format(name))
+                total -= self.loaded.pop(name).memory_estimate()
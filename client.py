@@ -1,6 +1,11 @@
 from socket import socket, AF_INET, SOCK_STREAM, error as SocketError
+from collections import OrderedDict
+from json import loads as from_json, dumps as to_json
 from typing import Tuple, Optional, Dict
+import argparse
 import hashlib
+import os
+import time
 
 import helper
 
@@ -11,7 +16,24 @@ REQUEST_CODE_NAMES = """1 - List all albums
 5 - Get album of song
 6 - Search song by name
 7 - Search song by lyrics
-8 - Quit """
+8 - Quit
+9 - Autocomplete song name
+10 - Autocomplete album name
+11 - Search songs by length
+12 - Longest songs
+13 - Shortest songs
+14 - Album summary
+15 - Most common words in lyrics
+16 - Songs with similar lyrics
+17 - Add a song (admins)
+18 - Update a song (admins)
+19 - Remove a song (admins)
+20 - Add an album (admins)
+21 - Rename an album (admins)
+22 - Remove an album (admins)
+23 - Choose a catalog
+24 - List catalogs
+25 - Search songs by a lyrics query """
 
 #   Missing requests codes do not hold data
 REQUEST_CODE_PROMPTS = {
@@ -21,12 +43,115 @@ REQUEST_CODE_PROMPTS = {
     5: 'Choose a song: ',
     6: 'Choose a word to search: ',
     7: 'Choose a a word to search: ',
+    9: 'Start of the song name: ',
+    10: 'Start of the album name: ',
+    11: 'Choose a length range and optionally an album '
+        '(min,max[,album] - for example 4:30,6): ',
+    12: 'How many songs and optionally an album (count[,album]): ',
+    13: 'How many songs and optionally an album (count[,album]): ',
+    14: 'Choose an album: ',
+    15: 'How many words and optionally an album (count[,album]): ',
+    16: 'How many songs and a song to compare to (count,song): ',
+    17: 'The song (album::song::author::mm:ss::lyrics): ',
+    18: 'The song (album::song::author::mm:ss::lyrics): ',
+    19: 'Choose a song: ',
+    20: 'Name of the new album: ',
+    21: 'The album and its new name (album::new name): ',
+    22: 'Choose an album: ',
+    23: 'Choose a catalog: ',
+    25: 'The query (words, "a phrase", and, or, not, parentheses - for '
+        'example money and not "dark side"): ',
 }
 
 PASSWORD = 'Pink Floyd'
 
+#   Where responses are cached between runs of the client
+CACHE_FILE_PATH = os.path.join(os.path.expanduser('~'),
+                               '.pink_floyd_cache.json')
+#   Responses kept in the cache, the least recently used are dropped
+CACHE_SIZE = 1000
+#   Seconds between saves of the cache while the client runs. It is also
+#   saved when the client exits.
+CACHE_SAVE_SECONDS = 30
+
 logged_user = None
 
+#   Whether the server offered the framed protocol in its welcome message.
+#   Set in connect_to_server, and asked for in do_user_login.
+framed_protocol = False
+
+#   Used by do_request_response. Set in main, None to not cache.
+response_cache = None
+
+
+class ServerBusyError(ConnectionError):
+    """ The server refused the connection because it is too busy. """
+    pass
+
+
+class ResponseCache:
+    """ Responses to queries, with the version of the catalog that answered
+        them. A cached response is sent to the server as a version, and is
+        used if the server replies it was not modified since.
+        Kept in memory and saved to a file now and then, not on every
+        response, as the file holds many lyrics.
+    """
+
+    def __init__(self, file_path: Optional[str], size: int = CACHE_SIZE):
+        """
+        :param file_path: Where the cache is loaded from and saved to.
+                          None to keep it in memory only.
+        :param size: Number of responses to keep.
+        """
+        self.file_path = file_path
+        self.size = size
+        #   (version, data) by request, least recently used first
+        self.responses = OrderedDict()
+        #   Whether there are responses that were not saved yet
+        self.changed = False
+        self.save_time = time.monotonic() + CACHE_SAVE_SECONDS
+        if file_path is not None and os.path.exists(file_path):
+            try:
+                with open(file_path, 'r') as file:
+                    self.responses.update(
+                        (key, tuple(value))
+                        for key, value in from_json(file.read()))
+            except ValueError:
+                print('The response cache is corrupt, starting over')
+
+    @staticmethod
+    def key(req_code: int, req_data: str, catalog: Optional[str]) -> str:
+        #   The server ignores case, so the cache does too
+        return '{}|{}|{}'.format(req_code, catalog or '', req_data).lower()
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """ :return: The version and data of the cached response, or None """
+        if key not in self.responses:
+            return None
+        self.responses.move_to_end(key)
+        return self.responses[key]
+
+    def put(self, key: str, version: str, data: str) -> None:
+        self.responses[key] = version, data
+        self.responses.move_to_end(key)
+        while len(self.responses) > self.size:
+            self.responses.popitem(last=False)
+        self.changed = True
+        if time.monotonic() >= self.save_time:
+            self.save()
+
+    def save(self) -> None:
+        """ Saves the cache to its file, if it changed. """
+        self.save_time = time.monotonic() + CACHE_SAVE_SECONDS
+        if self.file_path is None or not self.changed:
+            return
+        #   Replace the file at once, so a crash never leaves half of it
+        temp_path = self.file_path + '.tmp'
+        with open(temp_path, 'w') as file:
+            file.write(to_json(list(self.responses.items())))
+        os.replace(temp_path, self.file_path)
+        self.changed = False
+
 
 def encrypt_password(password: str) -> str:
     return hashlib.pbkdf2_hmac('sha256',
@@ -43,8 +168,8 @@ def get_response(sock: socket, request: bytes) -> Optional[Dict[str, str]]:
              If disconnected, returns None.
     """
     try:
-        sock.send(request)
-        response = sock.recv(1025)
+        helper.send_message(sock, request, framed_protocol)
+        response = helper.receive_message(sock, framed_protocol)
 
     except SocketError:
         return None
@@ -53,15 +178,27 @@ def get_response(sock: socket, request: bytes) -> Optional[Dict[str, str]]:
         return helper.parse_message(response)
 
 
-def connect_to_server() -> Tuple[socket, str]:
+def connect_to_server(unix_path: Optional[str] = None) -> Tuple[socket, str]:
     """ Opens a conversation with the server
+    :param unix_path: Connect through the unix domain socket at this path,
+                      for servers on the same machine. By default TCP.
     :return: A socket with the server and the server's welcome message
     :throws: SocketError
     """
-    sock = socket(AF_INET, SOCK_STREAM)
-    sock.connect(helper.SERVER_ADDR)
+    global framed_protocol
+    if unix_path is None:
+        sock = socket(AF_INET, SOCK_STREAM)
+        sock.connect(helper.SERVER_ADDR)
+    else:
+        sock = socket(helper.AF_UNIX, SOCK_STREAM)
+        sock.connect(unix_path)
 
-    welcome_msg = helper.parse_message(sock.recv(1024))['data']
+    welcome = helper.parse_message(helper.receive_message(sock, False))
+    if 'data' not in welcome:
+        sock.close()
+        raise ServerBusyError(format_msg(welcome))
+    welcome_msg = welcome['data']
+    framed_protocol = helper.uses_framed_protocol(welcome)
 
     return sock, welcome_msg
 
@@ -95,15 +232,14 @@ def do_user_login(sock: socket):
         if sign_out == 'y':
             logged_user = None
         else:
-            msg = helper.make_message(username=logged_user[0],
-                                      password=logged_user[1])
+            fields = dict(username=logged_user[0], password=logged_user[1])
 
     if logged_user is None:
         if input('Do you have an account on our server? y/n: ') == 'y':
             username = input('Enter your username: ')
             password = input('Enter your password: ')
             password = encrypt_password(password)
-            msg = helper.make_message(username=username, password=password)
+            fields = dict(username=username, password=password)
         else:
             proceed = 'n'
             while proceed != 'y':
@@ -115,12 +251,14 @@ def do_user_login(sock: socket):
                 password = encrypt_password(password)
                 proceed = input('Are you sure you want to proceed? y/n: ')
                 if proceed == 'y':
-                    msg = helper.make_message(username=username,
-                                              password=password,
-                                              new_user='')
+                    fields = dict(username=username, password=password,
+                                  new_user='')
     logged_user = (username, password)
-    sock.send(msg)
-    response = helper.parse_message(sock.recv(1024))
+    if framed_protocol:
+        fields[helper.PROTOCOL_FIELD] = helper.FRAMED_PROTOCOL
+    helper.send_message(sock, helper.make_message(**fields), False)
+    response = helper.parse_message(
+        helper.receive_message(sock, framed_protocol))
     if 'login_successful' not in response:
         print(format_msg(response))
         logged_user = None
@@ -147,15 +285,55 @@ def format_msg(message: Dict[str, str]) -> str:
         return 'Unknown message format: \n{}'.format(message)
 
 
-def do_request_response(sock: socket, req_code: int, req_data: str) -> bool:
+def make_request(sock: socket, req_code: int, req_data: str,
+                 catalog: Optional[str] = None,
+                 cache: Optional[ResponseCache] = None
+                 ) -> Optional[Dict[str, str]]:
+    """ Sends a request and gets its response, through a cache.
+    :param sock: The connection to the server
+    :param req_code: The request code
+    :param req_data: The data field of the request
+    :param catalog: Ask this catalog instead of the one chosen for the
+                    session (request 23).
+    :param cache: Where responses are cached. None to not cache.
+    :return: The response, as in get_response. A response the server
+             said was not modified has the cached data field.
+             If disconnected, returns None.
+    """
+    fields = dict(code=req_code, data=req_data)
+    if catalog is not None:
+        fields['catalog'] = catalog
+
+    key = cached = None
+    if cache is not None:
+        key = ResponseCache.key(req_code, req_data, catalog)
+        cached = cache.get(key)
+        if cached is not None:
+            fields['version'] = cached[0]
+
+    response = get_response(sock, helper.make_message(**fields))
+    if response is None or cache is None:
+        return response
+
+    if 'not_modified' in response and cached is not None:
+        response['data'] = cached[1]
+    elif 'version' in response and 'data' in response:
+        cache.put(key, response['version'], response['data'])
+    return response
+
+
+def do_request_response(sock: socket, req_code: int, req_data: str,
+                        catalog: Optional[str] = None) -> bool:
     """ Prints the result of the request to the user.
     :param sock: The connection to the server
     :param req_code: The request code
     :param req_data: The data field of the request
+    :param catalog: Ask this catalog instead of the one chosen for the
+                    session (request 23).
     :return: True if succesful, False if connection error
     """
-    request = helper.make_message(code=req_code, data=req_data)
-    response = get_response(sock, request)
+    response = make_request(sock, req_code, req_data, catalog,
+                            response_cache)
 
     if response is None:
         return False
@@ -172,7 +350,7 @@ def make_requests_to_server(sock: socket) -> bool:
     """
     while True:
         print(REQUEST_CODE_NAMES)
-        req_code = get_user_number(1, 8)
+        req_code = get_user_number(1, len(REQUEST_CODE_NAMES.splitlines()))
 
         #   If the request code requires data, ask for it
         req_data = ''
@@ -192,17 +370,22 @@ def ask_for_reconnect() -> bool:
     return reconnect == 'y'
 
 
-def start_conversation() -> None:
+def start_conversation(unix_path: Optional[str] = None) -> None:
     print('Connecting to server...', end='')
     try:
-        sock, welcome_msg = connect_to_server()
+        sock, welcome_msg = connect_to_server(unix_path)
+    except ServerBusyError as e:
+        print('failure! \n\n')
+        print(e)
+        if ask_for_reconnect():
+            start_conversation(unix_path)
     except SocketError:
         print('failure! \n\n')
         print('Cannot connect to server. '
               'Check your internet connection. '
               'Please try again.')
         if ask_for_reconnect():
-            start_conversation()
+            start_conversation(unix_path)
     else:
         with sock:
             print('connected! \n\n')
@@ -215,11 +398,34 @@ def start_conversation() -> None:
                 print('Oops! It seams you were disconnected. '
                       'Check your internet connection.')
                 if ask_for_reconnect():
-                    start_conversation()
+                    start_conversation(unix_path)
 
 
 def main():
-    start_conversation()
+    parser = argparse.ArgumentParser(description='The pink floyd client')
+    parser.add_argument('--unix', nargs='?', const=helper.SERVER_UNIX_PATH,
+                        metavar='PATH',
+                        help='Connect through a unix domain socket '
+                             '(default path {})'
+                             .format(helper.SERVER_UNIX_PATH))
+    parser.add_argument('--cache', default=CACHE_FILE_PATH, metavar='PATH',
+                        help='Where to cache responses between runs '
+                             '(default {})'.format(CACHE_FILE_PATH))
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Always get responses from the server')
+    args = parser.parse_args()
+    if args.unix is not None and helper.AF_UNIX is None:
+        parser.error(helper.UNIX_UNSUPPORTED)
+
+    global response_cache
+    if not args.no_cache:
+        response_cache = ResponseCache(args.cache)
+
+    try:
+        start_conversation(args.unix)
+    finally:
+        if response_cache is not None:
+            response_cache.save()
 
 
 if __name__ == '__main__':
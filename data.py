@@ -1,5 +1,25 @@
-from typing import Tuple, Dict, List, Set, NamedTuple, Iterable, Optional
+from typing import (Tuple, Dict, List, Set, NamedTuple, Iterable, Iterator,
+                    Optional, IO)
 from json import loads as from_json, dumps as to_json
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import heapq
+import hmac
+import math
+import multiprocessing
+import os
+import re
+import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    #   No file locks (Windows). The server runs a single process there, as
+    #   --workers needs fork, so a lock in the process is enough.
+    fcntl = None
 
 
 class SongInfo(NamedTuple):
@@ -9,14 +29,82 @@ class SongInfo(NamedTuple):
     time: float
 
 
-Albums = Dict[str, Set[str]]
+Albums = Dict[str, List[str]]
 Songs = Dict[str, SongInfo]
+WordCount = Tuple[str, int]
+#   Word -> the positions of the word in some lyrics (0 is the first word)
+WordPositions = Dict[str, Tuple[int, ...]]
+#   Word -> song -> the positions of the word in the lyrics of the song
+PositionalIndex = Dict[str, Dict[str, Tuple[int, ...]]]
+
+
+WORD_PATTERN = re.compile(r"[a-z']+")
+
+#   Tokens of lyrics queries: quoted phrases (maybe missing the closing
+#   quote), parentheses and anything else up to a space
+QUERY_TOKEN_PATTERN = re.compile(r'"[^"]*"?|[()]|[^\s()"]+')
+QUERY_OPERATORS = {'and', 'or', 'not'}
+
+#   Chunks of albums parse_dataset gives every process, so processes that
+#   finish early take more
+CHUNKS_PER_PROCESS = 4
+#   How the parse processes are started. Catalogs are loaded from session
+#   threads, and a process forked from many threads may start with a lock
+#   another thread held, so they are started from a clean process instead.
+PARSE_START_METHOD = ('forkserver' if 'forkserver' in
+                      multiprocessing.get_all_start_methods() else 'spawn')
+
+#   Number of get_similar_songs results to remember
+SIMILAR_CACHE_SIZE = 1024
+
+#   Passwords file name -> (modification time and size, logins in the file)
+LOGINS_CACHE: Dict[str, Tuple[Tuple[int, int], Dict[str, str]]] = dict()
+
+#   Taken by lock_file instead of a file lock when there is no fcntl
+FALLBACK_FILE_LOCK = threading.RLock()
+
+
+class AlbumStats(NamedTuple):
+    """ Totals of an album. """
+    track_count: int
+    total_time: float
+    word_counts: Counter
+
+
+class LyricsIndex(NamedTuple):
+    """ TF-IDF vectors of the lyrics, stored sparsely.
+    The weight of a word in a song is tf_weight * idf where
+    tf_weight = 1 + log(count of the word in the song) and
+    idf = log(number of songs / number of songs with the word).
+    """
+    vectors: Dict[str, Dict[str, float]]    # song -> word -> tf_weight
+    postings: Dict[str, Dict[str, float]]   # word -> song -> tf_weight
+    norms: Dict[str, float]                 # song -> length of its vector
+    similar_cache: OrderedDict              # (song, count) -> similar songs
+
+
+class LengthIndex(NamedTuple):
+    """ The songs sorted by their length.
+    lengths[i] is the length of the song songs[i].
+    """
+    lengths: List[float]
+    songs: List[str]
 
 
 class Dataset(NamedTuple):
-    """ The dataset is used for answering requests by the server. """
+    """ The dataset is used for answering requests by the server.
+    Fields other than songs and albums are indexes built from them
+    (see make_dataset).
+    """
     songs: Songs
     albums: Albums
+    song_names: List[str]   # Sorted, for prefix searches
+    album_names: List[str]  # Sorted, for prefix searches
+    lengths: LengthIndex
+    album_stats: Dict[str, AlbumStats]
+    word_counts: Counter    # Of the lyrics of all the songs
+    lyrics_index: LyricsIndex
+    word_positions: PositionalIndex
 
 
 def parse_song(song_text: str, album: str) -> Tuple[str, SongInfo]:
@@ -28,16 +116,52 @@ def parse_song(song_text: str, album: str) -> Tuple[str, SongInfo]:
     name, _, time, words = song_text.split('::')
     name = name.lower()
     words = words.lower()
-    minutes, _, seconds = time.partition(':')
-    time_float = int(minutes) + int(seconds) / 60
-    return name, SongInfo(lyrics=words, album=album, time=time_float)
+    return name, SongInfo(lyrics=words, album=album, time=parse_time(time))
 
 
-def parse_album(album_text: str) -> Tuple[str, Set[Tuple[str, SongInfo]]]:
+def parse_time(time_text: str) -> float:
+    """ Reads a time in the format mm:ss.
+    :return: The time in minutes.
+    :throws: ValueError
+    """
+    minutes, _, seconds = time_text.partition(':')
+    return int(minutes) + int(seconds) / 60
+
+
+def format_time(time: float) -> str:
+    """ Writes a time in minutes in the format mm:ss. """
+    minutes, seconds = divmod(round(time * 60), 60)
+    return '{:02}:{:02}'.format(minutes, seconds)
+
+
+def get_word_positions(words: Iterable[str]) -> WordPositions:
+    """ Where every word appears, by order of first appearance. """
+    positions = dict()
+    for position, word in enumerate(words):
+        positions.setdefault(word, []).append(position)
+    #   Unlike lists, tuples of numbers are left alone by the garbage
+    #   collector, which would otherwise go over millions of them
+    return {word: tuple(word_positions)
+            for word, word_positions in positions.items()}
+
+
+def count_words(word_positions: WordPositions) -> Counter:
+    """ The same as Counter(words) for the words of the positions. """
+    return Counter({word: len(positions)
+                    for word, positions in word_positions.items()})
+
+
+def split_words(text: str) -> List[str]:
+    """ The words in a lowercase text, such as lyrics. """
+    return WORD_PATTERN.findall(text)
+
+
+def parse_album_songs(
+        album_text: str) -> Tuple[str, List[Tuple[str, SongInfo]]]:
     """ Reads an album from part of the dataset.
     :param album_text: The text from the file.
     :return: The name of the album, along with a
-             list of songs inside it.
+             list of songs inside it, in the order of the file.
     """
     header, _, inner = album_text.partition('\n')
 
@@ -46,27 +170,260 @@ def parse_album(album_text: str) -> Tuple[str, Set[Tuple[str, SongInfo]]]:
 
     song_texts = inner.split('*')[1:]
 
-    return name, {parse_song(song_text, name) for song_text in song_texts}
+    return name, [parse_song(song_text, name) for song_text in song_texts]
 
 
-def parse_dataset(dataset_text: str) -> Dataset:
+def parse_album(album_text: str) -> Tuple[str, Set[Tuple[str, SongInfo]]]:
+    """ Reads an album from part of the dataset.
+    :param album_text: The text from the file.
+    :return: The name of the album, along with a
+             set of songs inside it.
+    """
+    name, songs = parse_album_songs(album_text)
+    return name, set(songs)
+
+
+def collect_albums(
+        albums: List[Tuple[str, Set[Tuple[str, SongInfo]]]]
+        ) -> Tuple[Songs, Albums]:
+    """ Puts the parsed albums together.
+    :param albums: As returned by parse_album, in the order of the file.
+    :return: All the songs, and the songs in every album.
+    """
+    albums_dict = {album_name: [song_name for song_name, _ in songs]
+                   for album_name, songs in albums}
+    songs_dict = dict()
+    for _, songs in albums:
+        for song_name, song_info in songs:
+            songs_dict[song_name] = song_info
+    return songs_dict, albums_dict
+
+
+def parse_dataset(dataset_text: str, processes: int = 1) -> Dataset:
     """ Reads the full dataset from text.
     :param dataset_text: The text in the format of the dataset.
+    :param processes: Parse in this many processes, see
+                      parse_dataset_parallel.
     :return: The dataset.
     """
+    if processes > 1:
+        return parse_dataset_parallel(dataset_text, processes)
+
     album_texts = dataset_text.split('#')
     album_texts = album_texts[1:]
 
     albums = [parse_album(album_text)
               for album_text in album_texts]
-    albums_dict = {album_name: [song_name for song_name, _ in songs]
-                   for album_name, songs in albums}
-    songs_dict = dict()
-    for _, songs in albums:
-        for song_name, song_info in songs:
-            songs_dict[song_name] = song_info
+    return make_dataset(*collect_albums(albums))
+
+
+def split_album_chunks(dataset_text: str, chunk_count: int) -> List[str]:
+    """ Splits the dataset text into about chunk_count chunks of whole
+        albums. Every chunk starts with the '#' of its first album.
+    """
+    chunk_size = len(dataset_text) // chunk_count + 1
+    chunks = []
+    start = dataset_text.find('#')
+    while start != -1:
+        end = dataset_text.find('#', start + chunk_size)
+        chunks.append(dataset_text[start:end if end != -1 else None])
+        start = end
+    return chunks
+
+
+def parse_album_chunk(
+        chunk_text: str
+        ) -> List[Tuple[str, List[Tuple[str, SongInfo, WordPositions]]]]:
+    """ Parses a chunk of albums, with the words of every song.
+        Runs in the processes of parse_dataset_parallel.
+    :param chunk_text: As returned by split_album_chunks.
+    :return: The name of every album, along with its songs and the
+             positions of their words, in the order of the file.
+    """
+    albums = []
+    for album_text in chunk_text.split('#')[1:]:
+        album_name, songs = parse_album_songs(album_text)
+        #   Interned words are sent back once per chunk instead of once
+        #   per song, and the dataset keeps one copy of each
+        albums.append((album_name, [
+            (song_name, song_info, get_word_positions(
+                map(sys.intern, split_words(song_info.lyrics))))
+            for song_name, song_info in songs]))
+    return albums
+
+
+def parse_dataset_parallel(dataset_text: str, processes: int) -> Dataset:
+    """ Reads the full dataset from text, parsing the albums and finding
+        the words of the songs in a pool of processes. The indexes that
+        need all the songs are built in this process.
+        The dataset is the same as parse_dataset's in every detail, even
+        the order of the songs in albums.
+        The processes import the main module (see PARSE_START_METHOD), so
+        scripts must only call it under if __name__ == '__main__'.
+    :param dataset_text: The text in the format of the dataset.
+    :param processes: The number of processes to parse in.
+    :return: The dataset.
+    """
+    chunks = split_album_chunks(dataset_text, processes * CHUNKS_PER_PROCESS)
+    context = multiprocessing.get_context(PARSE_START_METHOD)
+    with ProcessPoolExecutor(processes, mp_context=context) as executor:
+        parsed_albums = [album for chunk_albums
+                         in executor.map(parse_album_chunk, chunks)
+                         for album in chunk_albums]
+
+    #   Sets of songs are built here, like parse_album does, so they are
+    #   ordered as they would be in a serial parse
+    albums = [(album_name, {(song_name, song_info)
+                            for song_name, song_info, _ in songs})
+              for album_name, songs in parsed_albums]
+    songs, albums_dict = collect_albums(albums)
+
+    positions_by_song = {(song_name, song_info): word_positions
+                         for _, songs in parsed_albums
+                         for song_name, song_info, word_positions in songs}
+    song_word_positions = {song_name: positions_by_song[song_name, song_info]
+                           for song_name, song_info in songs.items()}
+
+    return make_dataset(songs, albums_dict, song_word_positions)
+
+
+def make_dataset(
+        songs: Songs, albums: Albums,
+        song_word_positions: Optional[Dict[str, WordPositions]] = None
+        ) -> Dataset:
+    """ Builds the indexes of the dataset.
+    :param songs: All the songs, by name.
+    :param albums: The names of the songs in every album, by album name.
+    :param song_word_positions: The positions of the words in the lyrics
+                                of every song, by name and in the order of
+                                songs, if they were already found.
+    :return: The dataset.
+    """
+    by_length = sorted((song_info.time, song_name)
+                       for song_name, song_info in songs.items())
+    lengths = LengthIndex(lengths=[time for time, _ in by_length],
+                          songs=[song_name for _, song_name in by_length])
+
+    if song_word_positions is None:
+        song_word_positions = {
+            song_name: get_word_positions(split_words(song_info.lyrics))
+            for song_name, song_info in songs.items()}
+    song_word_counts = {song_name: count_words(word_positions)
+                        for song_name, word_positions
+                        in song_word_positions.items()}
+    album_stats = {album_name: make_album_stats(songs, song_word_counts,
+                                                song_names)
+                   for album_name, song_names in albums.items()}
+    word_counts = Counter()
+    for stats in album_stats.values():
+        word_counts.update(stats.word_counts)
+
+    return Dataset(songs=songs,
+                   albums=albums,
+                   song_names=sorted(songs.keys()),
+                   album_names=sorted(albums.keys()),
+                   lengths=lengths,
+                   album_stats=album_stats,
+                   word_counts=word_counts,
+                   lyrics_index=make_lyrics_index(song_word_counts),
+                   word_positions=make_positional_index(song_word_positions))
+
+
+def make_album_stats(songs: Songs,
+                     song_word_counts: Dict[str, Counter],
+                     song_names: List[str]) -> AlbumStats:
+    """ Computes the totals of an album.
+    :param songs: All the songs, by name.
+    :param song_word_counts: The words in the lyrics of every song.
+    :param song_names: The songs in the album.
+    """
+    word_counts = Counter()
+    for song_name in song_names:
+        word_counts.update(song_word_counts[song_name])
+    return AlbumStats(
+        track_count=len(song_names),
+        total_time=sum(songs[song_name].time for song_name in song_names),
+        word_counts=word_counts)
 
-    return Dataset(songs=songs_dict, albums=albums_dict)
+
+def make_lyrics_index(song_word_counts: Dict[str, Counter]) -> LyricsIndex:
+    """ Builds the TF-IDF vectors of all the songs.
+    :param song_word_counts: The words in the lyrics of every song.
+    """
+    vectors = {song_name: {word: 1 + math.log(count)
+                           for word, count in word_counts.items()}
+               for song_name, word_counts in song_word_counts.items()}
+    postings = dict()
+    for song_name, vector in vectors.items():
+        for word, tf_weight in vector.items():
+            postings.setdefault(word, dict())[song_name] = tf_weight
+
+    idfs = {word: math.log(len(vectors) / len(word_postings))
+            for word, word_postings in postings.items()}
+    norms = {song_name: math.sqrt(sum((tf_weight * idfs[word]) ** 2
+                                      for word, tf_weight in vector.items()))
+             for song_name, vector in vectors.items()}
+
+    return LyricsIndex(vectors=vectors, postings=postings,
+                       norms=norms, similar_cache=OrderedDict())
+
+
+def make_positional_index(
+        song_word_positions: Dict[str, WordPositions]) -> PositionalIndex:
+    """ Builds the index of where every word appears, for phrase and
+        boolean queries (see search_lyrics_query).
+    :param song_word_positions: The positions of the words of every song.
+    """
+    index = dict()
+    for song_name, word_positions in song_word_positions.items():
+        for word, positions in word_positions.items():
+            index.setdefault(word, dict())[song_name] = positions
+    return index
+
+
+def get_idf(index: LyricsIndex, word: str) -> float:
+    return math.log(len(index.vectors) / len(index.postings[word]))
+
+
+def get_vector_norm(index: LyricsIndex, song_name: str) -> float:
+    """ The length of the TF-IDF vector of a song. Cached. """
+    norm = index.norms.get(song_name)
+    if norm is None:
+        norm = math.sqrt(sum((tf_weight * get_idf(index, word)) ** 2
+                             for word, tf_weight
+                             in index.vectors[song_name].items()))
+        index.norms[song_name] = norm
+    return norm
+
+
+def find_similar_songs(index: LyricsIndex,
+                       song_name: str,
+                       count: int) -> Optional[List[str]]:
+    """ Ranks the songs by the cosine similarity of their TF-IDF vectors to
+    the vector of song_name. The dot products with all the songs are
+    computed at once, going over the postings of the words of the song
+    (a sparse matrix-vector product), so songs sharing no words cost nothing.
+    """
+    vector = index.vectors.get(song_name)
+    if vector is None:
+        return None
+
+    dot_products = dict()
+    for word, tf_weight in vector.items():
+        idf = get_idf(index, word)
+        if idf == 0:
+            continue
+        weight = tf_weight * idf * idf
+        for other_name, other_tf_weight in index.postings[word].items():
+            dot_products[other_name] = (dot_products.get(other_name, 0) +
+                                        weight * other_tf_weight)
+    dot_products.pop(song_name, None)
+
+    similarities = ((dot_product / (get_vector_norm(index, other_name) or 1),
+                     other_name)
+                    for other_name, dot_product in dot_products.items())
+    return [other_name for _, other_name
+            in heapq.nlargest(count, similarities)]
 
 
 def get_albums(dataset: Dataset) -> Iterable[str]:
@@ -104,24 +461,543 @@ def search_song_by_lyrics(dataset: Dataset,
             if search_string in song_info.lyrics)
 
 
+class QueryError(Exception):
+    """ A lyrics query that cannot be read. """
+    pass
+
+
+class QueryNode(NamedTuple):
+    """ A part of a parsed lyrics query. """
+    operator: str   # 'phrase', 'and', 'or' or 'not'
+    operands: list  # The words of a phrase, or the nodes operated on
+
+
+class QueryParser:
+    """ Reads lyrics queries, in the grammar
+        query    := and_expr ('or' and_expr)*
+        and_expr := not_expr (['and'] not_expr)*
+        not_expr := 'not' not_expr | '(' query ')' | '"words"' | word
+    Words next to each other must all appear, like with 'and'.
+    """
+
+    def __init__(self, query: str):
+        self.tokens = QUERY_TOKEN_PATTERN.findall(query.lower())
+        self.position = 0
+
+    def peek(self) -> Optional[str]:
+        if self.position == len(self.tokens):
+            return None
+        return self.tokens[self.position]
+
+    def next(self) -> str:
+        token = self.peek()
+        if token is None:
+            raise QueryError('The query ended too soon')
+        self.position += 1
+        return token
+
+    def parse(self) -> QueryNode:
+        """ :throws: QueryError """
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise QueryError('Unexpected "{}"'.format(self.peek()))
+        return node
+
+    def parse_or(self) -> QueryNode:
+        operands = [self.parse_and()]
+        while self.peek() == 'or':
+            self.next()
+            operands.append(self.parse_and())
+        return operands[0] if len(operands) == 1 else QueryNode('or',
+                                                                operands)
+
+    def parse_and(self) -> QueryNode:
+        operands = [self.parse_not()]
+        while self.peek() not in (None, 'or', ')'):
+            if self.peek() == 'and':
+                self.next()
+            operands.append(self.parse_not())
+        return operands[0] if len(operands) == 1 else QueryNode('and',
+                                                                operands)
+
+    def parse_not(self) -> QueryNode:
+        token = self.next()
+        if token == 'not':
+            return QueryNode('not', [self.parse_not()])
+        if token == '(':
+            node = self.parse_or()
+            if self.peek() != ')':
+                raise QueryError('Missing ")"')
+            self.next()
+            return node
+        if token in QUERY_OPERATORS or token == ')':
+            raise QueryError('Unexpected "{}"'.format(token))
+
+        if token.startswith('"'):
+            if len(token) == 1 or not token.endswith('"'):
+                raise QueryError('Missing closing quote')
+            token = token[1:-1]
+        #   Like the index, "don't-stop" is the phrase "don't stop"
+        words = split_words(token)
+        if not words:
+            raise QueryError('"{}" has no words'.format(token))
+        return QueryNode('phrase', words)
+
+
+def find_phrase(index: PositionalIndex, words: List[str]) -> Set[str]:
+    """ The songs with the words one after the other in their lyrics. """
+    postings = [index.get(word, {}) for word in words]
+    #   Intersect the songs of the words, starting with the rarest
+    songs = None
+    for word_postings in sorted(postings, key=len):
+        if songs is None:
+            songs = set(word_postings)
+        else:
+            songs = {song_name for song_name in songs
+                     if song_name in word_postings}
+        if not songs:
+            return set()
+
+    if len(words) == 1:
+        return songs
+
+    matches = set()
+    for song_name in songs:
+        following = [set(word_postings[song_name])
+                     for word_postings in postings[1:]]
+        if any(all(start + offset in positions
+                   for offset, positions in enumerate(following, 1))
+               for start in postings[0][song_name]):
+            matches.add(song_name)
+    return matches
+
+
+def evaluate_query(dataset: Dataset, node: QueryNode) -> Set[str]:
+    """ The songs that match a parsed lyrics query. """
+    if node.operator == 'phrase':
+        return find_phrase(dataset.word_positions, node.operands)
+    if node.operator == 'or':
+        return set().union(*(evaluate_query(dataset, operand)
+                             for operand in node.operands))
+    if node.operator == 'not':
+        return (dataset.songs.keys() -
+                evaluate_query(dataset, node.operands[0]))
+
+    #   'and': intersect the operands, smallest first, then remove the
+    #   songs of negated operands instead of going over all the songs
+    included = [evaluate_query(dataset, operand)
+                for operand in node.operands if operand.operator != 'not']
+    excluded = [evaluate_query(dataset, operand.operands[0])
+                for operand in node.operands if operand.operator == 'not']
+    if not included:
+        included = [set(dataset.songs.keys())]
+    included.sort(key=len)
+    songs = included[0]
+    for other_songs in included[1:]:
+        if not songs:
+            break
+        songs = songs & other_songs
+    return songs.difference(*excluded)
+
+
+def search_lyrics_query(dataset: Dataset, query: str) -> List[str]:
+    """ Finds songs by a query on their lyrics, with the words of the
+        lyrics indexed by their positions (see make_positional_index).
+        A query has words, quoted phrases that must appear as they are
+        (even across lines), 'and', 'or', 'not' and parentheses:
+            money and ("dark side" or not moon)
+        Quote operators to search for them as words: "not".
+    :return: The matching songs, sorted.
+    :throws: QueryError
+    """
+    return sorted(evaluate_query(dataset, QueryParser(query).parse()))
+
+
+def complete_name(sorted_names: List[str],
+                  prefix: str,
+                  limit: int) -> List[str]:
+    """ Finds names that start with a prefix with a binary search.
+    :param sorted_names: The names to search in, sorted.
+    :param prefix: The start of the names.
+    :param limit: Maximum number of names to return.
+    :return: Up to limit names that start with prefix, in order.
+    """
+    start = bisect_left(sorted_names, prefix)
+    #   Names starting with the prefix are all next to each other
+    candidates = sorted_names[start:start + limit]
+    return [name for name in candidates if name.startswith(prefix)]
+
+
+def complete_song_name(dataset: Dataset,
+                       prefix: str,
+                       limit: int = 10) -> List[str]:
+    return complete_name(dataset.song_names, prefix, limit)
+
+
+def complete_album_name(dataset: Dataset,
+                        prefix: str,
+                        limit: int = 10) -> List[str]:
+    return complete_name(dataset.album_names, prefix, limit)
+
+
+def search_song_by_length(dataset: Dataset,
+                          min_length: float,
+                          max_length: float,
+                          album: Optional[str] = None) -> Optional[List[str]]:
+    """ Finds the songs with a length in a range, shortest first.
+    :param min_length: Inclusive minimum length in minutes.
+    :param max_length: Inclusive maximum length in minutes.
+    :param album: Only search in this album. By default search all songs.
+    :return: The names of the songs. None if the album does not exist.
+    """
+    if album is not None:
+        songs = sort_songs_by_length(dataset, album)
+        return (None if songs is None else
+                [song_name for song_name in songs
+                 if min_length <= dataset.songs[song_name].time <= max_length])
+
+    start = bisect_left(dataset.lengths.lengths, min_length)
+    end = bisect_right(dataset.lengths.lengths, max_length)
+    return dataset.lengths.songs[start:end]
+
+
+def get_longest_songs(dataset: Dataset,
+                      count: int,
+                      album: Optional[str] = None) -> Optional[List[str]]:
+    """ The longest songs, longest first.
+    :param count: Maximum number of songs to return.
+    :param album: Only search in this album. By default search all songs.
+    :return: The names of the songs. None if the album does not exist.
+    """
+    songs = (dataset.lengths.songs if album is None else
+             sort_songs_by_length(dataset, album))
+    if songs is None:
+        return None
+    return songs[:-count - 1:-1] if count > 0 else []
+
+
+def get_shortest_songs(dataset: Dataset,
+                       count: int,
+                       album: Optional[str] = None) -> Optional[List[str]]:
+    """ The shortest songs, shortest first.
+    :param count: Maximum number of songs to return.
+    :param album: Only search in this album. By default search all songs.
+    :return: The names of the songs. None if the album does not exist.
+    """
+    songs = (dataset.lengths.songs if album is None else
+             sort_songs_by_length(dataset, album))
+    if songs is None:
+        return None
+    return songs[:max(count, 0)]
+
+
+def sort_songs_by_length(dataset: Dataset,
+                         album: str) -> Optional[List[str]]:
+    """ The songs of an album, shortest first.
+    Albums are small, so they are sorted on demand and not indexed.
+    """
+    songs = dataset.albums.get(album)
+    if songs is None:
+        return None
+    return sorted(songs, key=lambda song_name: (dataset.songs[song_name].time,
+                                                song_name))
+
+
+def get_album_stats(dataset: Dataset, album: str) -> Optional[AlbumStats]:
+    return dataset.album_stats.get(album)
+
+
+def get_top_words(dataset: Dataset,
+                  count: int,
+                  album: Optional[str] = None) -> Optional[List[WordCount]]:
+    """ The most frequent words in the lyrics.
+    :param count: Maximum number of words to return.
+    :param album: Only count the words in this album.
+                  By default count the words of all songs.
+    :return: Words with the number of times they appear, most frequent first.
+             None if the album does not exist.
+    """
+    if album is None:
+        word_counts = dataset.word_counts
+    else:
+        stats = dataset.album_stats.get(album)
+        if stats is None:
+            return None
+        word_counts = stats.word_counts
+    return word_counts.most_common(max(count, 0))
+
+
+def get_similar_songs(dataset: Dataset,
+                      count: int,
+                      song_name: str) -> Optional[List[str]]:
+    """ The songs with the most similar lyrics, most similar first.
+    Results are cached, so popular songs are only ranked once.
+    :param count: Maximum number of songs to return.
+    :param song_name: The song to compare to.
+    :return: The names of the songs. None if the song does not exist.
+    """
+    cache = dataset.lyrics_index.similar_cache
+    key = (song_name, count)
+    similar_songs = cache.pop(key, None)
+    if similar_songs is None:
+        similar_songs = find_similar_songs(dataset.lyrics_index,
+                                           song_name, max(count, 0))
+        if similar_songs is None:
+            return None
+        while len(cache) >= SIMILAR_CACHE_SIZE:
+            cache.popitem(last=False)
+    cache[key] = similar_songs
+    return similar_songs
+
+
+class ChangeError(Exception):
+    """ A change to the dataset that cannot be applied. """
+    pass
+
+
+def remove_counts(counter: Counter, counts: Counter) -> None:
+    """ Subtracts counts from counter, dropping words that reach zero. """
+    for word, count in counts.items():
+        remaining = counter[word] - count
+        if remaining > 0:
+            counter[word] = remaining
+        else:
+            del counter[word]
+
+
+def index_song(dataset: Dataset, song_name: str, song_info: SongInfo) -> None:
+    """ Adds a song to the dataset and to all of its indexes.
+    Takes time proportional to the size of the song, except for inserting
+    into the sorted lists (a memory move).
+    The album of the song must exist.
+    """
+    dataset.songs[song_name] = song_info
+    dataset.albums[song_info.album].append(song_name)
+    dataset.song_names.insert(bisect_left(dataset.song_names, song_name),
+                              song_name)
+
+    #   Songs of the same length are sorted by name, as in make_dataset
+    start = bisect_left(dataset.lengths.lengths, song_info.time)
+    end = bisect_right(dataset.lengths.lengths, song_info.time)
+    position = bisect_left(dataset.lengths.songs, song_name, start, end)
+    dataset.lengths.lengths.insert(position, song_info.time)
+    dataset.lengths.songs.insert(position, song_name)
+
+    word_positions = get_word_positions(split_words(song_info.lyrics))
+    word_counts = count_words(word_positions)
+    stats = dataset.album_stats[song_info.album]
+    stats.word_counts.update(word_counts)
+    dataset.album_stats[song_info.album] = stats._replace(
+        track_count=stats.track_count + 1,
+        total_time=stats.total_time + song_info.time)
+    dataset.word_counts.update(word_counts)
+
+    index = dataset.lyrics_index
+    vector = {word: 1 + math.log(count)
+              for word, count in word_counts.items()}
+    index.vectors[song_name] = vector
+    for word, tf_weight in vector.items():
+        index.postings.setdefault(word, dict())[song_name] = tf_weight
+    #   The idf of every word changed, so the norms are computed again
+    #   when they are needed
+    index.norms.clear()
+    index.similar_cache.clear()
+
+    for word, positions in word_positions.items():
+        dataset.word_positions.setdefault(word, dict())[song_name] = positions
+
+
+def unindex_song(dataset: Dataset, song_name: str) -> SongInfo:
+    """ Removes a song from the dataset and from all of its indexes.
+    Takes time proportional to the size of the song and of its album,
+    except for removing from the sorted lists (a memory move).
+    :return: The details of the removed song.
+    """
+    song_info = dataset.songs.pop(song_name)
+    dataset.albums[song_info.album].remove(song_name)
+    del dataset.song_names[bisect_left(dataset.song_names, song_name)]
+
+    start = bisect_left(dataset.lengths.lengths, song_info.time)
+    end = bisect_right(dataset.lengths.lengths, song_info.time)
+    position = dataset.lengths.songs.index(song_name, start, end)
+    del dataset.lengths.lengths[position]
+    del dataset.lengths.songs[position]
+
+    word_counts = Counter(split_words(song_info.lyrics))
+    stats = dataset.album_stats[song_info.album]
+    remove_counts(stats.word_counts, word_counts)
+    dataset.album_stats[song_info.album] = stats._replace(
+        track_count=stats.track_count - 1,
+        total_time=stats.total_time - song_info.time)
+    remove_counts(dataset.word_counts, word_counts)
+
+    index = dataset.lyrics_index
+    for word in index.vectors.pop(song_name):
+        word_postings = index.postings[word]
+        del word_postings[song_name]
+        if not word_postings:
+            del index.postings[word]
+
+        word_positions = dataset.word_positions[word]
+        del word_positions[song_name]
+        if not word_positions:
+            del dataset.word_positions[word]
+    index.norms.clear()
+    index.similar_cache.clear()
+
+    return song_info
+
+
+def add_song(dataset: Dataset, album: str, name: str,
+             time: float, lyrics: str) -> None:
+    """ Adds a new song to an existing album.
+    :throws: ChangeError
+    """
+    if name in dataset.songs:
+        raise ChangeError('The song {} already exists'.format(name))
+    if album not in dataset.albums:
+        raise ChangeError('The album {} does not exist'.format(album))
+    index_song(dataset, name, SongInfo(album=album, lyrics=lyrics, time=time))
+
+
+def update_song(dataset: Dataset, album: str, name: str,
+                time: float, lyrics: str) -> None:
+    """ Replaces the details of a song. The song may move to another album.
+    :throws: ChangeError
+    """
+    if name not in dataset.songs:
+        raise ChangeError('The song {} does not exist'.format(name))
+    if album not in dataset.albums:
+        raise ChangeError('The album {} does not exist'.format(album))
+    unindex_song(dataset, name)
+    index_song(dataset, name, SongInfo(album=album, lyrics=lyrics, time=time))
+
+
+def remove_song(dataset: Dataset, name: str) -> None:
+    """ :throws: ChangeError """
+    if name not in dataset.songs:
+        raise ChangeError('The song {} does not exist'.format(name))
+    unindex_song(dataset, name)
+
+
+def add_album(dataset: Dataset, album: str) -> None:
+    """ Adds a new album, without songs.
+    :throws: ChangeError
+    """
+    if album in dataset.albums:
+        raise ChangeError('The album {} already exists'.format(album))
+    dataset.albums[album] = []
+    dataset.album_names.insert(bisect_left(dataset.album_names, album), album)
+    dataset.album_stats[album] = AlbumStats(track_count=0, total_time=0,
+                                            word_counts=Counter())
+
+
+def rename_album(dataset: Dataset, album: str, new_name: str) -> None:
+    """ :throws: ChangeError """
+    if album not in dataset.albums:
+        raise ChangeError('The album {} does not exist'.format(album))
+    if new_name in dataset.albums:
+        raise ChangeError('The album {} already exists'.format(new_name))
+
+    song_names = dataset.albums.pop(album)
+    dataset.albums[new_name] = song_names
+    for song_name in song_names:
+        song_info = dataset.songs[song_name]
+        dataset.songs[song_name] = song_info._replace(album=new_name)
+
+    del dataset.album_names[bisect_left(dataset.album_names, album)]
+    dataset.album_names.insert(bisect_left(dataset.album_names, new_name),
+                               new_name)
+    dataset.album_stats[new_name] = dataset.album_stats.pop(album)
+
+
+def remove_album(dataset: Dataset, album: str) -> None:
+    """ Removes an album and all of its songs.
+    :throws: ChangeError
+    """
+    if album not in dataset.albums:
+        raise ChangeError('The album {} does not exist'.format(album))
+    for song_name in list(dataset.albums[album]):
+        unindex_song(dataset, song_name)
+    del dataset.albums[album]
+    del dataset.album_names[bisect_left(dataset.album_names, album)]
+    del dataset.album_stats[album]
+
+
+#   The changes that can be applied with apply_change, by action
+CHANGES = {
+    'add_song': add_song,
+    'update_song': update_song,
+    'remove_song': remove_song,
+    'add_album': add_album,
+    'rename_album': rename_album,
+    'remove_album': remove_album,
+}
+
+
+def apply_change(dataset: Dataset, change: Dict) -> None:
+    """ Changes the dataset and its indexes in place.
+    :param change: The 'action' (a key of CHANGES) and the arguments of the
+                   function of the action. Can be stored as json.
+    :throws: ChangeError
+    """
+    arguments = dict(change)
+    action = CHANGES.get(arguments.pop('action', None))
+    if action is None:
+        raise ChangeError('Unknown change {}'.format(change))
+    action(dataset, **arguments)
+
+
 def password_compare(pass1: str, pass2: str) -> bool:
-    """ Use this to securely compare 2 passwords. """
-    matchs = True
-    for c1, c2 in zip(pass1, pass2):
-        matchs &= (c1 == c2)
-    if len(pass1) != len(pass2):
-        matchs = False
-    return matchs
+    """ Use this to securely compare 2 passwords.
+    Takes the same time wherever the passwords differ.
+    """
+    return hmac.compare_digest(pass1.encode(), pass2.encode())
+
+
+@contextmanager
+def lock_file(file: IO, exclusive: bool = True) -> Iterator[None]:
+    """ Locks an open file against other threads and server processes,
+        for the with block.
+    :param exclusive: False to share the lock with other readers.
+    """
+    if fcntl is None:
+        with FALLBACK_FILE_LOCK:
+            yield
+        return
+
+    fcntl.flock(file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    try:
+        yield
+    finally:
+        fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def read_logins(passwords_file_name: str) -> Dict[str, str]:
+    """ Reads the usernames and passwords in the passwords file.
+    The file is only parsed again if it changed since the last call.
+    :return: A dictionary from username to password. Do not modify it.
+    """
+    file_stat = os.stat(passwords_file_name)
+    version = file_stat.st_mtime_ns, file_stat.st_size
+
+    cached = LOGINS_CACHE.get(passwords_file_name)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    with open(passwords_file_name, 'r') as file:
+        #   Never read the file while add_new_user rewrites it
+        with lock_file(file, exclusive=False):
+            logins = from_json(file.read())
+    LOGINS_CACHE[passwords_file_name] = version, logins
+    return logins
 
 
 def password_matchs_username(passwords_file_name: str,
                              username: str,
                              password: str) -> bool:
     """ Securely checks if the password belongs to the username """
-    with open(passwords_file_name, 'r') as file:
-        text = file.read()
-
-    logins: Dict[str, str] = from_json(text)
+    logins = read_logins(passwords_file_name)
     logged_password = logins.get(username)
     if logged_password is None:
         return False
@@ -138,7 +1014,9 @@ def add_new_user(passwords_file_name: str,
     :param password: The password of the new user. Should be encrypted.
     :return: True if successful, False if a user of the same username exists.
     """
-    with open(passwords_file_name, 'r+') as file:
+    #   Other threads and server processes add users to the same file, and
+    #   one must not overwrite the user another just added
+    with open(passwords_file_name, 'r+') as file, lock_file(file):
         logins = from_json(file.read())
 
         if username in logins:
@@ -0,0 +1,140 @@
+""" Generates synthetic catalogs in the format of Pink_Floyd_DB.txt.
+
+The vocabulary, authors and word frequencies are taken from the real
+dataset, so the generated lyrics look (statistically) like real lyrics.
+
+Usage: python generate_dataset.py <number-of-songs> <output-file>
+"""
+import argparse
+import itertools
+import random
+import re
+from collections import Counter
+from typing import List, NamedTuple, TextIO
+
+SOURCE_DATASET_PATH = 'Pink_Floyd_DB.txt'
+
+#   Letters only, so words never contain characters that have a meaning in
+#   the dataset format ('#', '*', '::') or in the protocol ('&').
+WORD_PATTERN = re.compile(r"[A-Za-z']+")
+
+MIN_ALBUM_SONGS = 8
+MAX_ALBUM_SONGS = 12
+MIN_LINE_WORDS = 3
+MAX_LINE_WORDS = 8
+MIN_SONG_SECONDS = 60
+MAX_SONG_SECONDS = 23 * 60
+
+
+class Vocabulary(NamedTuple):
+    """ What the generated songs are made of. """
+    words: List[str]
+    #   The running totals of how common the words are, so random.choices
+    #   does not sum all the weights again for every line
+    cum_weights: List[int]
+    authors: List[str]
+
+
+def load_vocabulary(source_path: str = SOURCE_DATASET_PATH) -> Vocabulary:
+    """ Collects the words and authors used in a real dataset file.
+    :param source_path: A file in the format of the dataset.
+    :return: The words (with how common they are) and the authors.
+    """
+    with open(source_path, 'r') as file:
+        text = file.read()
+
+    word_counts = Counter()
+    authors = set()
+    for line in text.splitlines():
+        if line.startswith('#'):
+            continue
+        if line.startswith('*'):
+            _, author, _, line = line.split('::', 3)
+            authors.add(author)
+        word_counts.update(WORD_PATTERN.findall(line))
+
+    words, weights = zip(*word_counts.most_common())
+    return Vocabulary(words=list(words),
+                      cum_weights=list(itertools.accumulate(weights)),
+                      authors=sorted(authors))
+
+
+def make_title(rand: random.Random, vocabulary: Vocabulary,
+               max_words: int) -> str:
+    """ A random name for a song or album. """
+    count = rand.randint(1, max_words)
+    words = rand.choices(vocabulary.words,
+                         cum_weights=vocabulary.cum_weights, k=count)
+    return ' '.join(word.capitalize() for word in words)
+
+
+def make_song(rand: random.Random, vocabulary: Vocabulary,
+              index: int, max_lines: int) -> str:
+    """ A random song in the format of the dataset.
+    :param index: The number of the song, used to keep song names unique.
+    :param max_lines: Maximum number of lines in the lyrics.
+    """
+    name = '{} {}'.format(make_title(rand, vocabulary, 4), index)
+    author = rand.choice(vocabulary.authors)
+
+    seconds = int(rand.gauss(5 * 60, 2 * 60))
+    seconds = min(max(seconds, MIN_SONG_SECONDS), MAX_SONG_SECONDS)
+    time = '{:02}:{:02}'.format(*divmod(seconds, 60))
+
+    lines = []
+    for _ in range(rand.randint(1, max_lines)):
+        count = rand.randint(MIN_LINE_WORDS, MAX_LINE_WORDS)
+        words = rand.choices(vocabulary.words,
+                             cum_weights=vocabulary.cum_weights, k=count)
+        lines.append(' '.join(words).capitalize())
+
+    return '*{}::{}::{}::{}'.format(name, author, time, '\n'.join(lines))
+
+
+def write_dataset(file: TextIO, song_count: int,
+                  vocabulary: Vocabulary, seed: int = 0,
+                  max_lines: int = 20) -> None:
+    """ Writes a synthetic dataset, one album at a time.
+    :param file: Where to write the dataset.
+    :param song_count: How many songs in total.
+    :param vocabulary: As returned by load_vocabulary.
+    :param seed: Seed for the random generator, for reproducible files.
+    :param max_lines: Maximum number of lines in the lyrics of a song.
+    """
+    rand = random.Random(seed)
+    written = 0
+    album_index = 0
+    while written < song_count:
+        album_size = min(rand.randint(MIN_ALBUM_SONGS, MAX_ALBUM_SONGS),
+                         song_count - written)
+        album_name = '{} {}'.format(make_title(rand, vocabulary, 3),
+                                    album_index)
+        year = rand.randint(1965, 2014)
+
+        songs = [make_song(rand, vocabulary, written + i, max_lines)
+                 for i in range(album_size)]
+        file.write('#{}::{}\n'.format(album_name, year))
+        file.write('\n'.join(songs))
+        file.write('\n')
+
+        written += album_size
+        album_index += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('songs', type=int, help='Number of songs')
+    parser.add_argument('output', help='Path of the file to create')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-lines', type=int, default=20,
+                        help='Maximum number of lyrics lines in a song')
+    args = parser.parse_args()
+
+    vocabulary = load_vocabulary()
+    with open(args.output, 'w') as file:
+        write_dataset(file, args.songs, vocabulary,
+                      seed=args.seed, max_lines=args.max_lines)
+
+
+if __name__ == '__main__':
+    main()
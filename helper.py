@@ -1,13 +1,40 @@
 import hashlib
+import struct
+import time
+from socket import socket
 from typing import Optional, Dict
 
+try:
+    from socket import AF_UNIX
+except ImportError:
+    #   No unix domain sockets (Windows), the --unix options are refused
+    AF_UNIX = None
+
 SERVER_PORT = 1973
 SERVER_IP = '127.0.0.1'
 SERVER_ADDR = SERVER_IP, SERVER_PORT
 
+#   Default path of the unix domain socket, for clients on the same machine
+SERVER_UNIX_PATH = '/tmp/pink_floyd.sock'
+UNIX_UNSUPPORTED = '--unix is not supported on this system'
+
 FIELD_SEP = '&'
 NAME_VALUE_SEP = ':'
 
+#   The server offers this protocol in its welcome message, and clients
+#   that know it ask for it in their login message. From the reply to the
+#   login on, every message is sent after its length, so the reader knows
+#   where it ends however its bytes arrive. Older clients do not ask, and
+#   send and receive every message in a single call.
+PROTOCOL_FIELD = 'protocol'
+FRAMED_PROTOCOL = '2'
+LENGTH_FORMAT = '!I'
+LENGTH_SIZE = struct.calcsize(LENGTH_FORMAT)
+#   Longest message receive_message accepts by default
+MAX_MESSAGE_SIZE = 2 ** 26
+#   Bytes asked from the socket at a time, and the longest unframed message
+RECEIVE_SIZE = 2 ** 16
+
 
 class Error(Exception):
     """ An error in the protocol """
@@ -66,6 +93,97 @@ def make_message(**kwargs) -> bytes:
     return make_message_no_checksum(**kwargs)
 
 
+def uses_framed_protocol(message: Dict[str, str]) -> bool:
+    """ Whether a welcome message offers the framed protocol, or a login
+        message asks for it.
+    :param message: As returned by parse_message.
+    """
+    return message.get(PROTOCOL_FIELD) == FRAMED_PROTOCOL
+
+
+def send_message(sock: socket, message: bytes, framed: bool) -> None:
+    """ Sends a whole message.
+    :param message: As returned by make_message.
+    :param framed: Whether to send the length of the message before it, as
+                   in the framed protocol.
+    :throws: SocketError
+    """
+    if framed:
+        message = struct.pack(LENGTH_FORMAT, len(message)) + message
+    sock.sendall(message)
+
+
+def receive_exactly(sock: socket, size: int,
+                    deadline: Optional[float] = None) -> bytes:
+    """ Receives size bytes, however many recv calls they take.
+    :param deadline: The time.monotonic by which all the bytes must arrive.
+                     None to only wait the timeout of the socket for each
+                     recv.
+    :throws: SocketError, ConnectionAbortedError if the connection closed
+             before they all arrived, TimeoutError if the deadline passed.
+    """
+    chunks = []
+    while size > 0:
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError('The message took too long to arrive')
+            sock.settimeout(remaining)
+        chunk = sock.recv(min(size, RECEIVE_SIZE))
+        if not chunk:
+            raise ConnectionAbortedError('The connection was closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def receive_message(sock: socket, framed: bool,
+                    max_size: int = MAX_MESSAGE_SIZE,
+                    timeout: Optional[float] = None,
+                    wait_timeout: Optional[float] = None) -> bytes:
+    """ Receives a whole message sent with send_message.
+    :param framed: Whether the message was sent after its length. If not,
+                   the message is what a single recv returns.
+    :param max_size: Longest message to accept. The connection can not be
+                     used after a longer one, so it is an error like a
+                     closed connection.
+    :param timeout: Seconds the whole message may take, from its first
+                    byte. A peer that sends it a byte at a time can not
+                    make each recv wait anew. None to only wait the timeout
+                    of the socket for each recv.
+    :param wait_timeout: Seconds to wait for the first byte. By default
+                         timeout.
+    :return: The message, to be parsed with parse_message.
+    :throws: SocketError, TimeoutError if the message took too long.
+    """
+    if wait_timeout is None:
+        wait_timeout = timeout
+    previous_timeout = sock.gettimeout()
+    try:
+        if wait_timeout is not None:
+            sock.settimeout(wait_timeout)
+        first_bytes = sock.recv(min(max_size, RECEIVE_SIZE)
+                                if not framed else LENGTH_SIZE)
+        if not first_bytes:
+            raise ConnectionAbortedError('The connection was closed')
+        if not framed:
+            return first_bytes
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        length, = struct.unpack(
+            LENGTH_FORMAT,
+            first_bytes + receive_exactly(sock,
+                                          LENGTH_SIZE - len(first_bytes),
+                                          deadline))
+        if length > max_size:
+            raise ConnectionAbortedError('A message of {} bytes is too long'
+                                         .format(length))
+        return receive_exactly(sock, length, deadline)
+    finally:
+        #   The timeout of the socket still bounds the sends
+        sock.settimeout(previous_timeout)
+
+
 def parse_message(message: bytes) -> Optional[Dict[str, str]]:
     """
     :throws: Error
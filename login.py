@@ -0,0 +1,126 @@
+""" Verifies logins for the server in a bounded pool of threads.
+    The pool bounds how many logins read the password file at the same
+    time, and rejects logins at once when too many are waiting. The session
+    thread of a login still waits for its result.
+"""
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from typing import Optional
+import threading
+import time
+
+import data
+
+#   Seconds between the summaries of the login stats the server prints
+SUMMARY_SECONDS = 60
+
+
+class LoginStats:
+    """ Counters of the logins handled by a LoginPool. Thread safe. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.count = 0
+        self.failures = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.summary_time = self.start_time
+
+    def record(self, seconds: float, successful: bool) -> None:
+        """ Counts a login that was verified.
+        :param seconds: How long the verification took.
+        :param successful: Whether the password was correct.
+        """
+        with self.lock:
+            self.count += 1
+            self.failures += not successful
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def record_rejected(self) -> None:
+        """ Counts a login that was not verified, because the pool was full
+            or it took too long.
+        """
+        with self.lock:
+            self.rejected += 1
+
+    def summary(self) -> str:
+        with self.lock:
+            elapsed = time.monotonic() - self.start_time
+            average = self.total_seconds / self.count if self.count else 0
+            return ('{} logins ({} failed, {} rejected), {:.1f} logins/s, '
+                    'latency average {:.1f}ms max {:.1f}ms'
+                    .format(self.count, self.failures, self.rejected,
+                            self.count / elapsed if elapsed else 0,
+                            average * 1000, self.max_seconds * 1000))
+
+    def periodic_summary(self) -> Optional[str]:
+        """ The summary, at most once every SUMMARY_SECONDS.
+        :return: None if the last summary is more recent.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.summary_time < SUMMARY_SECONDS:
+                return None
+            self.summary_time = now
+        return self.summary()
+
+
+class LoginPool:
+    """ Runs login verifications in worker threads. At most queue_size
+        logins wait or run at the same time, others are rejected at once.
+        This bounds the work on the password file, not the time a session
+        thread spends logging in: login waits for the verification.
+    """
+
+    def __init__(self, password_file_path: str,
+                 workers: int, queue_size: int):
+        """
+        :param password_file_path: The json file with all the users.
+        :param workers: Number of logins verified at the same time.
+        :param queue_size: Number of logins that may wait or run.
+        """
+        self.password_file_path = password_file_path
+        self.executor = ThreadPoolExecutor(workers,
+                                           thread_name_prefix='login')
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.stats = LoginStats()
+
+    def verify(self, username: str, password: str, new_user: bool) -> bool:
+        """ Checks a login, or adds a new user. Runs in a worker thread. """
+        start = time.perf_counter()
+        if new_user:
+            successful = data.add_new_user(self.password_file_path,
+                                           username, password)
+        else:
+            successful = data.password_matchs_username(
+                self.password_file_path, username, password)
+        self.stats.record(time.perf_counter() - start, successful)
+        return successful
+
+    def login(self, username: str, password: str, new_user: bool,
+              timeout: float) -> Optional[bool]:
+        """ Checks a login, or adds a new user, in the pool.
+        :param new_user: Add a new user instead of checking the password.
+        :param timeout: Seconds to wait for the result.
+        :return: Whether the login succeeded.
+                 None if the pool is too busy to answer in time, and then
+                 no user was added.
+        """
+        if not self.slots.acquire(blocking=False):
+            self.stats.record_rejected()
+            return None
+
+        future = self.executor.submit(self.verify,
+                                      username, password, new_user)
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            if future.cancel() or not new_user:
+                self.stats.record_rejected()
+                return None
+            #   The user is being added already, so the client is told
+            #   whether it was rather than that the server is busy
+            return future.result()
@@ -0,0 +1,324 @@
+""" Replays requests recorded by the server (see capture.py) against a
+server, and reports the latency of every request code.
+
+Every recorded session is replayed on its own connection, logged in as the
+replay user (admin requests fail unless it is an admin). Requests are sent
+at their recorded times, sped up by --speed, or as fast as the server
+answers with --max-speed.
+
+To compare two builds, replay the same capture against both:
+    python replay.py capture.gz --output old.json
+    python replay.py capture.gz --baseline old.json
+"""
+from concurrent.futures import ThreadPoolExecutor
+from socket import (socket, SOCK_STREAM, create_connection,
+                    error as SocketError)
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import argparse
+import json
+import statistics
+import threading
+import time
+
+import benchmark
+import capture
+import client
+import helper
+
+#   The latencies of logging in are reported under this code
+LOGIN_CODE = 'login'
+
+REPLAY_USERNAME = 'replay'
+REPLAY_PASSWORD = 'replay'
+
+#   Sessions replayed at the same time with --max-speed
+MAX_SPEED_SESSIONS = 16
+
+
+class Target(NamedTuple):
+    """ The server to replay against and the user to log in as. """
+    address: Tuple[str, int]
+    unix_path: Optional[str]    # Connect through it instead of the address
+    username: str
+    password: str               # Encrypted, as the client sends it
+
+
+class ReplayStats:
+    """ The latencies of the replayed requests, by code. Thread safe. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = dict()
+        self.errors: Dict[str, int] = dict()
+        self.failed_sessions = 0
+
+    def record(self, code: str, seconds: float, error: bool) -> None:
+        """ Counts a request that was answered.
+        :param error: Whether the server answered with an error.
+        """
+        with self.lock:
+            self.latencies.setdefault(code, []).append(seconds * 1_000_000)
+            self.errors[code] = self.errors.get(code, 0) + error
+
+    def record_failed_session(self) -> None:
+        """ Counts a session that lost its connection. """
+        with self.lock:
+            self.failed_sessions += 1
+
+    def summary(self, seconds: float) -> Dict:
+        """ :param seconds: How long the replay took. """
+        codes = dict()
+        with self.lock:
+            for code, latencies in sorted(self.latencies.items()):
+                latencies = sorted(latencies)
+                codes[code] = {
+                    'count': len(latencies),
+                    'errors': self.errors[code],
+                    'median_us': statistics.median(latencies),
+                    'p95_us': latencies[int(len(latencies) * 0.95)],
+                    'max_us': latencies[-1],
+                }
+            return {
+                'requests': sum(len(latencies) for latencies
+                                in self.latencies.values()),
+                'failed_sessions': self.failed_sessions,
+                'seconds': seconds,
+                'codes': codes,
+            }
+
+
+def connect(target: Target) -> Tuple[socket, bool]:
+    """ Connects to the server and reads its welcome message.
+    :return: The socket, and whether the server offered the framed
+             protocol.
+    :throws: SocketError, also if the server is busy.
+    """
+    if target.unix_path is None:
+        sock = create_connection(target.address)
+    else:
+        sock = socket(helper.AF_UNIX, SOCK_STREAM)
+        sock.connect(target.unix_path)
+
+    welcome = helper.parse_message(helper.receive_message(sock, False))
+    if 'data' not in welcome:
+        sock.close()
+        raise client.ServerBusyError(client.format_msg(welcome))
+    return sock, helper.uses_framed_protocol(welcome)
+
+
+def log_in(sock: socket, target: Target, framed: bool,
+           new_user: bool = False) -> bool:
+    """ Logs in, in the protocol the server offered.
+    :param framed: Ask for the framed protocol.
+    :return: Whether the server accepted the login.
+    """
+    fields = dict(username=target.username, password=target.password)
+    if new_user:
+        fields['new_user'] = ''
+    if framed:
+        fields[helper.PROTOCOL_FIELD] = helper.FRAMED_PROTOCOL
+    helper.send_message(sock, helper.make_message(**fields), False)
+    return 'login_successful' in helper.parse_message(
+        helper.receive_message(sock, framed))
+
+
+def add_replay_user(target: Target) -> None:
+    """ Adds the replay user to the server, if it is not there already.
+    :throws: SocketError, helper.Error if the password is wrong.
+    """
+    sock, framed = connect(target)
+    with sock:
+        if log_in(sock, target, framed):
+            return
+    sock, framed = connect(target)
+    with sock:
+        if not log_in(sock, target, framed, new_user=True):
+            raise helper.Error('Could not log in as {}'
+                               .format(target.username))
+
+
+def wait_until(start: float, offset: float) -> None:
+    """ Sleeps until offset seconds after start (a time.monotonic). """
+    delay = start + offset - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+
+def replay_session(requests: List[capture.CapturedRequest],
+                   target: Target,
+                   stats: ReplayStats,
+                   start: float,
+                   first_time: float,
+                   speed: Optional[float]) -> None:
+    """ Replays the requests of a session on a new connection.
+    :param start: When the replay started, a time.monotonic.
+    :param first_time: The recorded time of the first request in the
+                       capture, replayed at start.
+    :param speed: How many times faster than recorded to replay.
+                  None to send every request as soon as the previous one
+                  was answered.
+    """
+    try:
+        request_start = time.perf_counter()
+        sock, framed = connect(target)
+        with sock:
+            if not log_in(sock, target, framed):
+                raise helper.Error('Could not log in')
+            stats.record(LOGIN_CODE, time.perf_counter() - request_start,
+                         False)
+
+            for request in requests:
+                if speed is not None:
+                    wait_until(start, (request.time - first_time) / speed)
+
+                fields = {name: value for name, value
+                          in zip(('code', 'data', 'catalog'),
+                                 (request.code, request.data,
+                                  request.catalog))
+                          if value is not None}
+                request_start = time.perf_counter()
+                helper.send_message(sock, helper.make_message(**fields),
+                                    framed)
+                message = helper.receive_message(sock, framed)
+                seconds = time.perf_counter() - request_start
+                try:
+                    error = 'error' in helper.parse_message(message)
+                except helper.Error:
+                    #   The message was read whole, so the replies that
+                    #   follow are still in order
+                    error = True
+                stats.record(str(request.code), seconds, error)
+
+                if (str(request.code).isdigit() and
+                        helper.is_exit_request_code(int(request.code))):
+                    break
+    except (SocketError, helper.Error):
+        stats.record_failed_session()
+
+
+def replay(requests: List[capture.CapturedRequest],
+           target: Target,
+           speed: Optional[float],
+           max_speed_sessions: int = MAX_SPEED_SESSIONS) -> Dict:
+    """ Replays captured requests against a server.
+    :param speed: How many times faster than recorded to replay (1 for the
+                  recorded times). None to replay as fast as possible.
+    :param max_speed_sessions: Sessions replayed at the same time when
+                               replaying as fast as possible.
+    :return: As returned by ReplayStats.summary.
+    """
+    sessions: Dict[str, List[capture.CapturedRequest]] = dict()
+    for request in requests:
+        sessions.setdefault(request.session, []).append(request)
+
+    stats = ReplayStats()
+    first_time = requests[0].time if requests else 0
+    start = time.monotonic()
+
+    if speed is None:
+        with ThreadPoolExecutor(max_speed_sessions) as executor:
+            for session_requests in sessions.values():
+                executor.submit(replay_session, session_requests, target,
+                                stats, start, first_time, None)
+    else:
+        #   Sessions are ordered by their first request
+        threads = []
+        for session_requests in sessions.values():
+            wait_until(start, (session_requests[0].time - first_time) / speed)
+            thread = threading.Thread(
+                target=replay_session,
+                args=(session_requests, target, stats,
+                      start, first_time, speed))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    return stats.summary(time.monotonic() - start)
+
+
+def print_results(result: Dict, baseline: Optional[Dict] = None) -> None:
+    """ Prints the results as a table.
+    If a baseline is given, the latencies are compared to it and
+    regressions are marked, as in benchmark.py.
+    """
+    def compare(value: float, old_value: Optional[float]) -> str:
+        if old_value is None or old_value == 0:
+            return ''
+        ratio = value / old_value
+        mark = (' REGRESSION' if ratio > benchmark.REGRESSION_THRESHOLD
+                else '')
+        return ' (x{:.2f}{})'.format(ratio, mark)
+
+    old_codes = (baseline or {}).get('codes', {})
+    print('{:,} requests in {:.1f}s, {} sessions failed'.format(
+        result['requests'], result['seconds'], result['failed_sessions']))
+    for code, latency in result['codes'].items():
+        old_latency = old_codes.get(code, {})
+        print('  code {:<6} {:>7,} requests {:>6,} errors  median {:>10.1f}us'
+              '  p95 {:>10.1f}us{}'.format(
+                  code, latency['count'], latency['errors'],
+                  latency['median_us'], latency['p95_us'],
+                  compare(latency['median_us'],
+                          old_latency.get('median_us'))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('captures', nargs='+', metavar='CAPTURE',
+                        help='Capture files, all the files of a server '
+                             'that ran with --workers')
+    speed = parser.add_mutually_exclusive_group()
+    speed.add_argument('--speed', type=float, default=1,
+                       help='How many times faster than recorded to replay '
+                            '(default 1, the recorded times)')
+    speed.add_argument('--max-speed', action='store_true',
+                       help='Send every request as soon as the previous '
+                            'one of its session was answered')
+    parser.add_argument('--sessions', type=int, default=MAX_SPEED_SESSIONS,
+                        help='Sessions replayed at the same time with '
+                             '--max-speed')
+    parser.add_argument('--port', type=int, default=helper.SERVER_PORT,
+                        help='The TCP port of the server')
+    parser.add_argument('--unix', nargs='?', const=helper.SERVER_UNIX_PATH,
+                        metavar='PATH',
+                        help='Connect through a unix domain socket '
+                             '(default path {})'
+                             .format(helper.SERVER_UNIX_PATH))
+    parser.add_argument('--username', default=REPLAY_USERNAME,
+                        help='The user to replay as, added if needed')
+    parser.add_argument('--password', default=REPLAY_PASSWORD)
+    parser.add_argument('--output', help='Save the results as json')
+    parser.add_argument('--baseline',
+                        help='Results of a previous replay to compare '
+                             'against')
+    args = parser.parse_args()
+    if args.unix is not None and helper.AF_UNIX is None:
+        parser.error(helper.UNIX_UNSUPPORTED)
+
+    requests = capture.read_captures(args.captures)
+    target = Target(address=(helper.SERVER_IP, args.port),
+                    unix_path=args.unix,
+                    username=args.username,
+                    password=client.encrypt_password(args.password))
+    add_replay_user(target)
+
+    print('Replaying {:,} requests...'.format(len(requests)))
+    result = replay(requests, target,
+                    None if args.max_speed else args.speed, args.sessions)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+
+    print('')
+    print_results(result, baseline)
+
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
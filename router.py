@@ -0,0 +1,630 @@
+""" A router for a catalog split into shards, each served by its own
+server.py process. Clients talk to the router as they would to a server.
+
+Every song belongs to one shard, chosen by a hash of its name (see
+shard_of), and every shard has all the albums. Requests about one song go
+to the song's shard. Searches and listings go to all the shards at the
+same time, and their results are merged.
+
+The router logs clients in to every shard with their own username and
+password, so the shards must share the password file (run them in the
+same directory).
+
+To try it on one machine:
+    python router.py --local 3
+splits the dataset into 3 shards and runs a server for each.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from socket import socket, create_connection, error as SocketError
+from typing import Dict, List, Optional, Tuple
+import argparse
+import heapq
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+import traceback
+import zlib
+
+import data
+import helper
+import server
+
+#   Requests whose data is a song name, answered by the song's shard
+SONG_CODES = {3, 4, 5, 19}
+#   Requests whose data is <album>::<song>::..., answered by the song's shard
+SONG_CHANGE_CODES = {17, 18}
+#   Requests answered by every shard, with the lists merged
+LIST_CODES = {1, 2, 6, 7, 25}
+SONGS_IN_ALBUM_CODE = 2
+#   Answered by every shard with server.TIMED_LENGTH_SEARCH_CODE, and the
+#   songs merged by length
+LENGTH_SEARCH_CODE = 11
+#   Requests that change every shard, as every shard has every album
+ADD_ALBUM_CODE = 20
+RENAME_ALBUM_CODE = 21
+REMOVE_ALBUM_CODE = 22
+ALBUM_CHANGE_CODES = {ADD_ALBUM_CODE, RENAME_ALBUM_CODE, REMOVE_ALBUM_CODE}
+#   Requests any shard can answer, as every shard has every album
+ANY_SHARD_CODES = {8, 10}
+COMPLETE_SONG_CODE = 9
+
+#   Names autocompleted, as in data.complete_song_name
+COMPLETE_LIMIT = 10
+
+#   Where the shards of the dataset are written for --local
+SHARDS_DIR = 'shards'
+SHARD_FILE_NAME = '{}.shard{}.txt'
+SHARD_LOG_NAME = '{}.shard{}.log'
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'server.py')
+#   Seconds to wait for local shards to start listening
+SHARD_START_TIMEOUT = 30
+
+
+def shard_of(song_name: str, shard_count: int) -> int:
+    """ The shard a song belongs to. Unlike hash(), the same in every
+        process.
+    """
+    return zlib.crc32(song_name.lower().encode()) % shard_count
+
+
+def split_dataset(dataset_text: str, shard_count: int) -> List[str]:
+    """ Splits a dataset into shards, in the format of the dataset.
+    :param dataset_text: The text in the format of the dataset.
+    :return: The text of every shard. Every shard has all the albums, and
+             the songs shard_of puts in it.
+    """
+    shard_texts = [[] for _ in range(shard_count)]
+    for album_text in dataset_text.split('#')[1:]:
+        header, _, inner = album_text.partition('\n')
+        for texts in shard_texts:
+            texts.append('#{}\n'.format(header))
+
+        for song_text in inner.split('*')[1:]:
+            name, _, _ = song_text.partition('::')
+            shard_texts[shard_of(name, shard_count)].append('*' + song_text)
+
+    return [''.join(texts) for texts in shard_texts]
+
+
+def write_shards(dataset_path: str,
+                 shard_count: int,
+                 directory: str) -> List[str]:
+    """ Splits a dataset file into shard files, see split_dataset.
+    :return: The paths of the shard files.
+    """
+    with open(dataset_path, 'r', newline='') as file:
+        shard_texts = split_dataset(file.read(), shard_count)
+
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(dataset_path))[0]
+    paths = []
+    for index, shard_text in enumerate(shard_texts):
+        path = os.path.join(directory, SHARD_FILE_NAME.format(stem, index))
+        with open(path, 'w', newline='') as file:
+            file.write(shard_text)
+        paths.append(path)
+    return paths
+
+
+def start_local_shards(dataset_path: str,
+                       shard_count: int,
+                       directory: str,
+                       first_port: int,
+                       admins: List[str]) -> List[subprocess.Popen]:
+    """ Splits a dataset into shards and serves each shard with a server on
+        this machine, on the ports after first_port. Their output goes to
+        log files in the directory.
+    :return: The server processes, listening when this returns.
+    """
+    stem = os.path.splitext(os.path.basename(dataset_path))[0]
+    admin_args = [arg for admin in admins for arg in ('--admin', admin)]
+    processes = []
+    for index, path in enumerate(write_shards(dataset_path, shard_count,
+                                              directory)):
+        log_path = os.path.join(directory, SHARD_LOG_NAME.format(stem, index))
+        with open(log_path, 'w') as log:
+            processes.append(subprocess.Popen(
+                [sys.executable, SERVER_SCRIPT, '--dataset', path,
+                 '--port', str(first_port + index)] + admin_args,
+                stdout=log, stderr=subprocess.STDOUT))
+
+    deadline = time.monotonic() + SHARD_START_TIMEOUT
+    try:
+        for index in range(shard_count):
+            address = helper.SERVER_IP, first_port + index
+            while True:
+                try:
+                    create_connection(address).close()
+                    break
+                except SocketError:
+                    if time.monotonic() > deadline:
+                        raise
+                    time.sleep(0.1)
+    except BaseException:
+        for process in processes:
+            process.terminate()
+        raise
+    return processes
+
+
+class ShardSession:
+    """ The connections of a client to all the shards, logged in as the
+        client. Used by one session thread at a time.
+    """
+
+    def __init__(self,
+                 addresses: List[Tuple[str, int]],
+                 executor: ThreadPoolExecutor,
+                 timeout: float):
+        """
+        :param addresses: The address of every shard, by shard number.
+        :param executor: Sends requests to the shards in parallel.
+        :param timeout: Seconds to wait for a shard.
+        """
+        self.addresses = addresses
+        self.executor = executor
+        self.timeout = timeout
+        self.socks: List[socket] = []
+        #   Whether each shard uses the framed protocol, which the router
+        #   asks for whatever the client asked for
+        self.framed: List[bool] = []
+
+    def __len__(self) -> int:
+        return len(self.addresses)
+
+    def receive(self, index: int) -> Dict[str, str]:
+        framed = index < len(self.framed) and self.framed[index]
+        message = helper.receive_message(self.socks[index], framed,
+                                         timeout=self.timeout)
+        fields = helper.parse_message(message)
+        #   The router checksums the messages it sends itself
+        fields.pop('checksum', None)
+        return fields
+
+    def login(self, login_request: Dict[str, str]) -> Dict[str, str]:
+        """ Logs in to every shard with the login message of the client.
+            The first shard adds new users, and the others find them in the
+            shared password file.
+        :return: The reply of the last shard, which is the first to fail
+                 if any did.
+        :throws: SocketError
+        """
+        fields = {name: value for name, value in login_request.items()
+                  if name not in ('checksum', helper.PROTOCOL_FIELD)}
+        for index, address in enumerate(self.addresses):
+            self.socks.append(create_connection(address, self.timeout))
+            welcome = self.receive(index)
+            if 'data' not in welcome:
+                return welcome
+
+            login_fields = dict(fields)
+            if helper.uses_framed_protocol(welcome):
+                login_fields[helper.PROTOCOL_FIELD] = helper.FRAMED_PROTOCOL
+            helper.send_message(self.socks[index],
+                                helper.make_message(**login_fields), False)
+            self.framed.append(helper.uses_framed_protocol(login_fields))
+            reply = self.receive(index)
+            if 'login_successful' not in reply:
+                return reply
+            fields.pop('new_user', None)
+        return reply
+
+    def request(self, index: int, fields: Dict[str, str]) -> Dict[str, str]:
+        """ Sends a request to a shard and gets its response.
+        :throws: helper.Error if the shard is unavailable.
+        """
+        try:
+            helper.send_message(self.socks[index],
+                                helper.make_message(**fields),
+                                self.framed[index])
+            return self.receive(index)
+        except SocketError:
+            #   A late response would be taken as the next one
+            self.socks[index].close()
+            raise helper.Error('Shard {} is unavailable'.format(index))
+
+    def request_all(self, fields: Dict[str, str]) -> List[Dict[str, str]]:
+        """ Sends a request to all the shards at once.
+        :return: The response of every shard, by shard number. A shard that
+                 is unavailable answers with an error, and the others still
+                 get the request.
+        """
+        futures = [self.executor.submit(self.request, index, fields)
+                   for index in range(len(self))]
+        responses = []
+        for future in futures:
+            try:
+                responses.append(future.result())
+            except helper.Error as e:
+                responses.append(dict(error=str(e)))
+        return responses
+
+    def close(self) -> None:
+        for sock in self.socks:
+            sock.close()
+
+
+def merge_lists(datas: List[str]) -> str:
+    """ Merges lists the shards answered with, as written by
+        server.get_response_data. Items more than one shard answered with
+        (like albums) appear once.
+    """
+    #   Messages are lowercase
+    empty, not_found = server.EMPTY_LIST.lower(), server.NOT_FOUND.lower()
+    if all(data == not_found for data in datas):
+        return server.NOT_FOUND
+
+    items = dict.fromkeys(item for data in datas
+                          if data not in (empty, not_found)
+                          for item in data.split('\n'))
+    return '\n'.join(items) or server.EMPTY_LIST
+
+
+def merge_completions(datas: List[str]) -> str:
+    """ Merges the names the shards autocompleted. """
+    names = merge_lists(datas)
+    if names == server.EMPTY_LIST:
+        return names
+    return '\n'.join(sorted(names.split('\n'))[:COMPLETE_LIMIT])
+
+
+def merge_by_length(datas: List[str]) -> str:
+    """ Merges the songs the shards found by length, written by
+        server.format_timed_songs, shortest first like
+        data.search_song_by_length.
+    """
+    empty, not_found = server.EMPTY_LIST.lower(), server.NOT_FOUND.lower()
+    if all(shard_data == not_found for shard_data in datas):
+        return server.NOT_FOUND
+
+    shard_songs = []
+    for shard_data in datas:
+        if shard_data in (empty, not_found):
+            continue
+        songs = []
+        for line in shard_data.split('\n'):
+            time, _, song_name = line.partition(server.SONG_FIELD_SEP)
+            songs.append((data.parse_time(time), song_name))
+        shard_songs.append(songs)
+
+    #   Every shard's songs are sorted already
+    return ('\n'.join(song_name for _, song_name in heapq.merge(*shard_songs))
+            or server.EMPTY_LIST)
+
+
+def album_change_checks(req_code: int,
+                        req_data: str) -> Tuple[List[str], List[str]]:
+    """ The albums that must exist, and the albums that must not, for an
+        album change to succeed.
+    """
+    if req_code == ADD_ALBUM_CODE:
+        return [], [req_data]
+    if req_code == RENAME_ALBUM_CODE:
+        album, sep, new_name = req_data.partition(server.SONG_FIELD_SEP)
+        #   Without a separator every shard answers that it is malformed
+        return ([album], [new_name]) if sep else ([], [])
+    return [req_data], []
+
+
+def undo_album_change(req_code: int,
+                      req_data: str) -> Optional[Tuple[int, str]]:
+    """ The request code and data that undo an album change.
+    :return: None if the change can not be undone, like removing an album
+             (with its songs).
+    """
+    if req_code == ADD_ALBUM_CODE:
+        return REMOVE_ALBUM_CODE, req_data
+    if req_code == RENAME_ALBUM_CODE:
+        album, _, new_name = req_data.partition(server.SONG_FIELD_SEP)
+        return RENAME_ALBUM_CODE, new_name + server.SONG_FIELD_SEP + album
+    return None
+
+
+def change_albums(shards: ShardSession,
+                  req_code: int,
+                  req_data: str,
+                  fields: Dict[str, str]) -> Dict[str, str]:
+    """ Applies an album change to every shard, or to none of them.
+        The change is checked on every shard before it is applied, and if
+        it still fails on a shard (it became unavailable) it is undone on
+        the others where it can be.
+    :param fields: The fields of the request.
+    :return: The fields of the response.
+    :throws: helper.Error
+    """
+    not_found = server.NOT_FOUND.lower()
+    must_exist, must_not_exist = album_change_checks(req_code, req_data)
+    checks = ([(album, True) for album in must_exist] +
+              [(album, False) for album in must_not_exist])
+    for album, should_exist in checks:
+        check_fields = dict(fields, code=SONGS_IN_ALBUM_CODE, data=album)
+        for response in shards.request_all(check_fields):
+            if 'data' not in response:
+                return response
+            if (response['data'] != not_found) != should_exist:
+                raise helper.Error('The album {} {}'.format(
+                    album, 'does not exist' if should_exist
+                    else 'already exists'))
+
+    responses = shards.request_all(fields)
+    failed = [response for response in responses if 'data' not in response]
+    if not failed:
+        return responses[0]
+
+    applied = [index for index, response in enumerate(responses)
+               if 'data' in response]
+    undo = undo_album_change(req_code, req_data)
+    if undo is not None:
+        undo_fields = dict(fields, code=undo[0], data=undo[1])
+        for index in list(applied):
+            try:
+                if 'data' in shards.request(index, undo_fields):
+                    applied.remove(index)
+            except helper.Error:
+                pass
+    if applied:
+        raise helper.Error('{} (the change stays applied to shards {})'
+                           .format(failed[0].get('error', 'A shard failed'),
+                                   ', '.join(map(str, applied))))
+    return failed[0]
+
+
+def route(shards: ShardSession, request: Dict[str, str]) -> Dict[str, str]:
+    """ Answers a request of a client from the shards.
+    :param shards: The client's connections to the shards.
+    :param request: As returned by helper.parse_message.
+    :return: The fields of the response.
+    :throws: helper.Error
+    """
+    if 'code' not in request or 'data' not in request:
+        raise helper.Error('Message need a code field and a data field!')
+    if not request['code'].isdigit():
+        raise helper.Error('The code field must be a number')
+    req_code = int(request['code'])
+    req_data = request['data']
+    if req_code in server.ADMIN_RESPONSES:
+        server.check_change_request(request)
+    fields = {name: value for name, value in request.items()
+              if name != 'checksum'}
+
+    if req_code in SONG_CODES:
+        return shards.request(shard_of(req_data, len(shards)), fields)
+    if req_code in SONG_CHANGE_CODES:
+        song_name = req_data.split(server.SONG_FIELD_SEP)[1:2]
+        return shards.request(shard_of(''.join(song_name), len(shards)),
+                              fields)
+    if req_code in ANY_SHARD_CODES:
+        return shards.request(0, fields)
+
+    if (req_code not in LIST_CODES and req_code not in ALBUM_CHANGE_CODES
+            and req_code not in (COMPLETE_SONG_CODE, LENGTH_SEARCH_CODE)):
+        raise helper.Error('Request code {} is not supported by the router'
+                           .format(req_code))
+
+    #   A merged response has no single version to cache it by
+    fields.pop('version', None)
+    if req_code in ALBUM_CHANGE_CODES:
+        return change_albums(shards, req_code, req_data, fields)
+    if req_code == LENGTH_SEARCH_CODE:
+        fields['code'] = server.TIMED_LENGTH_SEARCH_CODE
+
+    responses = shards.request_all(fields)
+    for response in responses:
+        if 'data' not in response:
+            return response
+    datas = [response['data'] for response in responses]
+
+    if req_code == COMPLETE_SONG_CODE:
+        return dict(data=merge_completions(datas))
+    elif req_code == LENGTH_SEARCH_CODE:
+        return dict(data=merge_by_length(datas))
+    else:
+        return dict(data=merge_lists(datas))
+
+
+def do_request_response(sock: socket, shards: ShardSession,
+                        framed: bool, limits: server.Limits) -> bool:
+    """ Will respond to the next request from the client.
+    :param sock: The connection to the client.
+    :param shards: The client's connections to the shards.
+    :param framed: Whether the client uses the framed protocol.
+    :param limits: Bounds on the work the router takes.
+    :return: True if succesful, False if client disconnected.
+    """
+    try:
+        request = server.recieve(sock, framed, limits.read_timeout,
+                                 limits.idle_timeout)
+        response = route(shards, request)
+        server.send(sock, framed=framed, **response)
+
+        if helper.is_exit_request_code(int(request['code'])):
+            return False
+
+    except helper.ChecksumError as e:
+        server.send(sock, False, framed,
+                    error='checksumerror',
+                    actual=e.actual_checksum,
+                    expected=e.expected_checksum)
+
+    except helper.Error as e:
+        server.send(sock, False, framed, error=str(e))
+
+    except SocketError:
+        return False
+
+    return True
+
+
+def serve_session(sock: socket,
+                  addresses: List[Tuple[str, int]],
+                  executor: ThreadPoolExecutor,
+                  limits: server.Limits) -> None:
+    """ Welcomes an accepted client, logs it in to the shards and answers
+        its requests until it disconnects.
+    """
+    shards = ShardSession(addresses, executor, limits.read_timeout)
+    with sock:
+        try:
+            sock.settimeout(limits.read_timeout)
+            server.send(sock, checksum=False, data=server.WELCOME,
+                        protocol=helper.FRAMED_PROTOCOL)
+            login_request = server.recieve(sock,
+                                           timeout=limits.read_timeout)
+            if 'username' not in login_request:
+                server.send(sock, False, error='Expected a login message')
+                return
+
+            framed = helper.uses_framed_protocol(login_request)
+            reply = shards.login(login_request)
+            server.send(sock, framed=framed, **reply)
+            if 'login_successful' not in reply:
+                return
+
+            while do_request_response(sock, shards, framed, limits):
+                pass
+            print('Client disconnected!')
+        except helper.Error:
+            pass
+        except SocketError:
+            print('Could not log in to the shards')
+        finally:
+            shards.close()
+
+
+def run_sessions(clients: queue.Queue,
+                 addresses: List[Tuple[str, int]],
+                 executor: ThreadPoolExecutor,
+                 limits: server.Limits) -> None:
+    """ Serves clients from the queue, one after the other. """
+    while True:
+        client_sock = clients.get()
+        try:
+            serve_session(client_sock, addresses, executor, limits)
+        except Exception:
+            traceback.print_exc()
+
+
+def serve_forever(listen_sock: socket,
+                  addresses: List[Tuple[str, int]],
+                  limits: server.Limits) -> None:
+    """ Accepts clients and serves them in limits.max_sessions threads,
+        like server.serve_forever.
+    :param addresses: The address of every shard, by shard number.
+    """
+    #   Every session may wait for all the shards at once
+    executor = ThreadPoolExecutor(limits.max_sessions * len(addresses),
+                                  thread_name_prefix='shard')
+    clients = queue.Queue(limits.queue_size)
+    for _ in range(limits.max_sessions):
+        threading.Thread(target=run_sessions,
+                         args=(clients, addresses, executor, limits),
+                         daemon=True).start()
+
+    while True:
+        client_sock = server.accept_client(listen_sock)
+        if client_sock is None:
+            continue
+
+        try:
+            clients.put_nowait(client_sock)
+        except queue.Full:
+            print('Too many clients, rejecting a client')
+            server.reject_client(client_sock, limits)
+
+
+def parse_address(text: str) -> Tuple[str, int]:
+    """ Reads an address in the format [host:]port. """
+    host, _, port = text.rpartition(':')
+    return host or helper.SERVER_IP, int(port)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description='Routes requests to a catalog split into shards')
+    parser.add_argument('--shard', action='append', default=[],
+                        type=parse_address, metavar='[HOST:]PORT',
+                        help='The server of the next shard (give one for '
+                             'every shard, in order)')
+    parser.add_argument('--local', type=int, metavar='COUNT',
+                        help='Split the dataset into COUNT shards and serve '
+                             'them from this machine, on the ports after '
+                             'the router\'s')
+    parser.add_argument('--dataset', default=server.DATASET_FILE_PATH,
+                        metavar='PATH',
+                        help='The dataset to split with --local')
+    parser.add_argument('--shards-dir', default=SHARDS_DIR, metavar='DIR',
+                        help='Where --local writes the shards and the logs '
+                             'of their servers')
+    parser.add_argument('--admin', action='append', default=[],
+                        metavar='USERNAME',
+                        help='A user that may change the catalog, passed '
+                             'to the --local servers. The user must have '
+                             'signed up already')
+    parser.add_argument('--port', type=int, default=helper.SERVER_PORT,
+                        help='The TCP port to listen on')
+    parser.add_argument('--max-sessions', type=int,
+                        default=server.MAX_SESSIONS,
+                        help='Clients served at the same time')
+    parser.add_argument('--queue-size', type=int, default=server.QUEUE_SIZE,
+                        help='Clients that may wait for a session before '
+                             'new clients are told the router is busy')
+    parser.add_argument('--read-timeout', type=float,
+                        default=server.READ_TIMEOUT,
+                        help='Seconds a client has to log in and to send '
+                             'the rest of a request it started, and the '
+                             'shards have to respond')
+    parser.add_argument('--idle-timeout', type=float,
+                        default=server.IDLE_TIMEOUT,
+                        help='Seconds a client may wait between requests')
+    args = parser.parse_args()
+    if not args.shard and args.local is None:
+        parser.error('Give the shards with --shard, or use --local')
+    #   As in server.parse_args
+    for option in ('max_sessions', 'queue_size', 'read_timeout',
+                   'idle_timeout'):
+        if getattr(args, option) <= 0:
+            parser.error('--{} must be positive'
+                         .format(option.replace('_', '-')))
+    return args
+
+
+def main():
+    args = parse_args()
+
+    limits = server.Limits(max_sessions=args.max_sessions,
+                           queue_size=args.queue_size,
+                           login_workers=server.LOGIN_WORKERS,
+                           login_queue_size=server.LOGIN_QUEUE_SIZE,
+                           read_timeout=args.read_timeout,
+                           idle_timeout=args.idle_timeout)
+
+    addresses = list(args.shard)
+    processes = []
+    if args.local is not None:
+        processes = start_local_shards(args.dataset, args.local,
+                                       args.shards_dir, args.port + 1,
+                                       args.admin)
+        addresses += [(helper.SERVER_IP, args.port + 1 + index)
+                      for index in range(args.local)]
+
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        with server.get_listen_socket((helper.SERVER_IP, args.port)) as sock:
+            print('Router listening, {} shards'.format(len(addresses)))
+            serve_forever(sock, addresses, limits)
+    except KeyboardInterrupt:
+        print('Router stopped')
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
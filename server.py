@@ -1,8 +1,29 @@
-from socket import socket, AF_INET, SOCK_STREAM, error as SocketError
-from typing import Optional, Dict
+from socket import (socket, AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR,
+                    error as SocketError)
+from typing import Optional, Dict, List, Tuple, NamedTuple
 from collections.abc import Iterable
+import argparse
+import gc
+import itertools
+import os
+import queue
+import selectors
+import stat
+import signal
+import threading
+import time
+import traceback
+import capture
 import data
 import helper
+import login
+from catalog import Catalog, CatalogStore
+
+try:
+    from socket import SO_REUSEPORT
+except ImportError:
+    #   No SO_REUSEPORT (Windows), --workers is refused
+    SO_REUSEPORT = None
 
 RESPONSES = {
     1: lambda x, y: data.get_albums(x),
@@ -13,13 +34,304 @@ RESPONSES = {
     6: data.search_song_by_name,
     7: data.search_song_by_lyrics,
     8: lambda x, y: 'Goodbye!',
+    9: data.complete_song_name,
+    10: data.complete_album_name,
+    11: lambda x, y: data.search_song_by_length(x, *parse_length_range(y)),
+    12: lambda x, y: data.get_longest_songs(x, *parse_count(y)),
+    13: lambda x, y: data.get_shortest_songs(x, *parse_count(y)),
+    14: lambda x, y: format_album_stats(data.get_album_stats(x, y)),
+    15: lambda x, y: format_word_counts(
+        data.get_top_words(x, *parse_count(y))),
+    16: lambda x, y: data.get_similar_songs(x, *parse_count_and_name(y)),
+    25: lambda x, y: search_lyrics_query(x, y),
+    26: lambda x, y: format_timed_songs(
+        x, data.search_song_by_length(x, *parse_length_range(y))),
+}
+
+#   Requests that change the catalog. Each one turns the data field of
+#   the request into a change for data.apply_change.
+ADMIN_RESPONSES = {
+    17: lambda y: parse_song_change('add_song', y),
+    18: lambda y: parse_song_change('update_song', y),
+    19: lambda y: dict(action='remove_song', name=y),
+    20: lambda y: dict(action='add_album', album=y),
+    21: lambda y: parse_album_rename(y),
+    22: lambda y: dict(action='remove_album', album=y),
 }
 
+#   Requests about the catalogs themselves rather than their content
+USE_CATALOG_CODE = 23
+LIST_CATALOGS_CODE = 24
+
+#   Like request 11, with the length of every song. Not in the client's
+#   menu, router.py merges the songs of shards in order with it.
+TIMED_LENGTH_SEARCH_CODE = 26
+
+#   Separates the arguments of requests that take more than one
+ARGUMENT_SEP = ','
+
+#   Separates the fields of songs, like in the dataset file
+SONG_FIELD_SEP = '::'
+
 WELCOME = 'Welcome to the pink floyd server!'
+EMPTY_LIST = 'Empty list'
+NOT_FOUND = 'Parameter was not found'
+BUSY = 'The server is busy, please try again later'
 
 DATASET_FILE_PATH = 'Pink_Floyd_DB.txt'
+DEFAULT_CATALOG_NAME = 'pink floyd'
+CATALOG_FILE_EXTENSION = '.txt'
 PASSWORD_FILE_PATH = 'Passwords.txt'
 
+#   Longest request the server reads, room for the lyrics of a long song
+MAX_REQUEST_SIZE = 2 ** 20
+
+#   Users that may change the catalog. Set with --admin.
+ADMIN_USERNAMES = set()
+
+#   Records the requests when the server runs with --capture
+CAPTURE = capture.Capture()
+
+#   Numbers the sessions of this process
+SESSION_NUMBERS = itertools.count(1)
+
+#   Seconds to wait before replacing a worker process that exited
+WORKER_RESTART_DELAY = 1
+
+#   Connections the kernel queues before the server accepts them
+LISTEN_BACKLOG = 128
+
+#   Defaults of the Limits, per process
+MAX_SESSIONS = 16
+QUEUE_SIZE = 32
+LOGIN_WORKERS = 4
+LOGIN_QUEUE_SIZE = 64
+READ_TIMEOUT = 60
+IDLE_TIMEOUT = 300
+
+#   Megabytes the loaded catalogs may take, per process
+MEMORY_BUDGET = 1024
+
+
+class Limits(NamedTuple):
+    """ Bounds on the work the server takes. """
+    max_sessions: int       # Clients served at the same time
+    queue_size: int         # Clients waiting for a session, others are busy
+    login_workers: int      # Logins verified at the same time
+    login_queue_size: int   # Logins waiting or verified, others are busy
+    read_timeout: float     # Seconds for logging in, for each send and for
+    #                         each request once its first byte arrived
+    idle_timeout: float     # Seconds a client may wait between requests
+
+
+class Session:
+    """ The state of a logged in client. """
+
+    def __init__(self, username: str, catalog_name: str, framed: bool):
+        """
+        :param username: The user logged in on this connection.
+        :param catalog_name: The catalog requests are answered from, unless
+                             they name another one.
+        :param framed: Whether the client asked for the framed protocol
+                       (see helper.FRAMED_PROTOCOL).
+        """
+        self.username = username
+        self.catalog_name = catalog_name
+        self.framed = framed
+        #   Unique among the worker processes too
+        self.id = '{}.{}'.format(os.getpid(), next(SESSION_NUMBERS))
+
+
+def split_arguments(request_data: str,
+                    min_count: int,
+                    max_count: int) -> List[str]:
+    """ Splits the data field of a request into its arguments.
+    The last argument may contain ARGUMENT_SEP, as song and album names can.
+    :param request_data: The data field of the request.
+    :param min_count: The number of required arguments.
+    :param max_count: The number of required and optional arguments.
+    :return: The arguments, without surrounding whitespace.
+    :throws: helper.Error
+    """
+    arguments = [argument.strip() for argument in
+                 request_data.split(ARGUMENT_SEP, max_count - 1)]
+    if len(arguments) < min_count:
+        raise helper.Error('Expected {} arguments separated by "{}"'
+                           .format(min_count, ARGUMENT_SEP))
+    return arguments
+
+
+def parse_minutes(text: str) -> float:
+    """ Reads a length given as minutes (5, 4.5) or as mm:ss (04:30).
+    :throws: helper.Error
+    """
+    try:
+        return data.parse_time(text) if ':' in text else float(text)
+    except ValueError:
+        raise helper.Error('"{}" is not a valid length'.format(text))
+
+
+def parse_length_range(
+        request_data: str) -> Tuple[float, float, Optional[str]]:
+    """ Reads the data of a request in the format <min>,<max>[,<album>].
+    :return: The minimum length, maximum length and album (or None).
+    :throws: helper.Error
+    """
+    arguments = split_arguments(request_data, 2, 3)
+    album = arguments[2] if len(arguments) == 3 else None
+    return parse_minutes(arguments[0]), parse_minutes(arguments[1]), album
+
+
+def parse_count(request_data: str) -> Tuple[int, Optional[str]]:
+    """ Reads the data of a request in the format <count>[,<name>].
+    :return: The count and the name (or None).
+    :throws: helper.Error
+    """
+    arguments = split_arguments(request_data, 1, 2)
+    name = arguments[1] if len(arguments) == 2 else None
+    try:
+        return int(arguments[0]), name
+    except ValueError:
+        raise helper.Error('"{}" is not a number'.format(arguments[0]))
+
+
+def parse_count_and_name(request_data: str) -> Tuple[int, str]:
+    """ Reads the data of a request in the format <count>,<name>.
+    :throws: helper.Error
+    """
+    count, name = parse_count(request_data)
+    if name is None:
+        raise helper.Error('Expected a count and a name separated by "{}"'
+                           .format(ARGUMENT_SEP))
+    return count, name
+
+
+def parse_song_change(action: str, request_data: str) -> Dict:
+    """ Reads the data of a request in the format
+        <album>::<song>::<author>::<mm:ss>::<lyrics>
+    :param action: 'add_song' or 'update_song'.
+    :return: A change for data.apply_change.
+    :throws: helper.Error
+    """
+    album, _, song_text = request_data.partition(SONG_FIELD_SEP)
+    try:
+        name, song_info = data.parse_song(song_text, album)
+    except ValueError:
+        raise helper.Error('Expected <album>{0}<song>{0}<author>{0}<mm:ss>'
+                           '{0}<lyrics>'.format(SONG_FIELD_SEP))
+    return dict(action=action, album=album, name=name,
+                time=song_info.time, lyrics=song_info.lyrics)
+
+
+def parse_album_rename(request_data: str) -> Dict:
+    """ Reads the data of a request in the format <album>::<new name>.
+    :return: A change for data.apply_change.
+    :throws: helper.Error
+    """
+    album, sep, new_name = request_data.partition(SONG_FIELD_SEP)
+    if not sep:
+        raise helper.Error('Expected <album>{}<new name>'
+                           .format(SONG_FIELD_SEP))
+    return dict(action='rename_album', album=album, new_name=new_name)
+
+
+def get_catalog(store: CatalogStore, name: str) -> Catalog:
+    """ The catalog with this name, loaded if needed.
+    :throws: helper.Error
+    """
+    catalog = store.get(name)
+    if catalog is None:
+        raise helper.Error('There is no catalog named "{}"'.format(name))
+    return catalog
+
+
+def answer_catalogs_request(store: CatalogStore,
+                            session: Session,
+                            request_code: int,
+                            request_data: str) -> str:
+    """ Answers a request that chooses a catalog or lists them.
+    :param request_code: USE_CATALOG_CODE or LIST_CATALOGS_CODE.
+    :return: A string to be read by the client.
+    :throws: helper.Error
+    """
+    if request_code == LIST_CATALOGS_CODE:
+        return '\n'.join(name + (' (in use)'
+                                 if name == session.catalog_name else '')
+                         for name in store.names())
+
+    name = request_data.strip().lower()
+    get_catalog(store, name)
+    session.catalog_name = name
+    return 'Using the {} catalog'.format(name)
+
+
+def check_change_request(request: Dict[str, str]) -> None:
+    """ Checks that a request may change a catalog. A message without a
+        checksum may have been cut short, and must not be journaled.
+    :param request: As returned by helper.parse_message.
+    :throws: helper.Error
+    """
+    if 'checksum' not in request:
+        raise helper.Error('Changes to the catalog need a checksum')
+
+
+def change_catalog(catalog: Catalog,
+                   username: str,
+                   request_code: int,
+                   request_data: str) -> str:
+    """ Answers a request that changes the catalog.
+    :param catalog: The catalog to change.
+    :param username: The user that sent the request. Must be an admin.
+    :param request_code: A key of ADMIN_RESPONSES.
+    :param request_data: The data field of the request.
+    :return: A string to be read by the client.
+    :throws: helper.Error
+    """
+    if username not in ADMIN_USERNAMES:
+        raise helper.Error('Only admins can change the catalog')
+
+    change = ADMIN_RESPONSES[request_code](request_data.lower())
+    try:
+        catalog.change(change)
+    except data.ChangeError as e:
+        raise helper.Error(str(e))
+    return 'Done'
+
+
+def search_lyrics_query(dataset: data.Dataset, query: str) -> List[str]:
+    """ Answers a lyrics query, see data.search_lyrics_query.
+    :throws: helper.Error
+    """
+    try:
+        return data.search_lyrics_query(dataset, query)
+    except data.QueryError as e:
+        raise helper.Error(str(e))
+
+
+def format_timed_songs(dataset: data.Dataset,
+                       song_names: Optional[List[str]]
+                       ) -> Optional[List[str]]:
+    """ Writes songs as <mm:ss>::<song>. """
+    if song_names is None:
+        return None
+    return ['{}{}{}'.format(data.format_time(dataset.songs[song_name].time),
+                            SONG_FIELD_SEP, song_name)
+            for song_name in song_names]
+
+
+def format_album_stats(stats: Optional[data.AlbumStats]) -> Optional[str]:
+    if stats is None:
+        return None
+    return 'Tracks: {}\nTotal length: {}'.format(
+        stats.track_count, data.format_time(stats.total_time))
+
+
+def format_word_counts(
+        word_counts: Optional[List[data.WordCount]]) -> Optional[List[str]]:
+    if word_counts is None:
+        return None
+    return ['{} - {}'.format(word, count) for word, count in word_counts]
+
 
 def get_response_data(dataset: data.Dataset,
                       request_code: int,
@@ -30,52 +342,86 @@ def get_response_data(dataset: data.Dataset,
     :param request_data: The data field of the request.
     :return: A string to be read by the client
     """
-    resp_func = RESPONSES[request_code]
+    resp_func = RESPONSES.get(request_code)
+    if resp_func is None:
+        raise helper.Error('Unknown request code {}'.format(request_code))
     response_value = resp_func(dataset, request_data.lower())
 
     if (isinstance(response_value, Iterable) and
             not isinstance(response_value, str)):
         msg = '\n'.join(response_value)
         if msg == '':
-            msg = 'Empty list'
+            msg = EMPTY_LIST
     elif isinstance(response_value, float):
         msg = '{:.2f}'.format(response_value)
     elif response_value is None:
-        msg = 'Parameter was not found'
+        msg = NOT_FOUND
     else:
         msg = str(response_value)
 
     return msg
 
 
-def get_listen_socket() -> socket:
+def get_listen_socket(address: Tuple[str, int],
+                      reuse_port: bool = False) -> socket:
+    """ Opens the TCP socket the server accepts clients on.
+    :param address: The address to listen on, (ip, port).
+    :param reuse_port: Let other processes listen on the same address, with
+                       the kernel balancing connections between them.
+    """
     sock = socket(AF_INET, SOCK_STREAM)
-    sock.bind(helper.SERVER_ADDR)
-    sock.listen(1)
+    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(address)
+    sock.listen(LISTEN_BACKLOG)
+    return sock
+
+
+def get_unix_listen_socket(path: str) -> socket:
+    """ Opens a unix domain socket the server accepts clients on.
+        Clients on the same machine skip the TCP stack with it.
+    :param path: Where to create the socket. A socket left there by a
+                 previous run is replaced.
+    """
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.remove(path)
+    sock = socket(helper.AF_UNIX, SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(LISTEN_BACKLOG)
     return sock
 
 
-def recieve(sock: socket) -> Dict[str, str]:
+def recieve(sock: socket, framed: bool = False,
+            timeout: Optional[float] = None,
+            wait_timeout: Optional[float] = None) -> Dict[str, str]:
     """ Receives a message from the client and prints it.
     :param sock: The socket with the client.
+    :param framed: Whether the client uses the framed protocol.
+    :param timeout: Seconds for the whole message, as in
+                    helper.receive_message.
+    :param wait_timeout: Seconds to wait for the message to start.
     :return: A dictionary as returned by helper.parse_message.
     """
-    message = sock.recv(1024)
+    message = helper.receive_message(sock, framed, MAX_REQUEST_SIZE,
+                                     timeout, wait_timeout)
     print('Client: {}'.format(message.decode()))
     return helper.parse_message(message)
 
 
-def send(sock: socket, checksum: bool = True, **kwargs) -> None:
+def send(sock: socket, checksum: bool = True, framed: bool = False,
+         **kwargs) -> None:
     """ Sends a message to the client and prints it.
     :param sock: The client socket.
     :param checksum: Wether or not a checksum should be included. Default True.
+    :param framed: Whether the client uses the framed protocol.
     :param kwargs: The fields of the message, like in helper.make_message.
     """
     message = (helper.make_message(**kwargs)
                if checksum else
                helper.make_message_no_checksum(**kwargs))
     print('Server: {}'.format(message.decode().replace('\n', ', ')))
-    sock.send(message)
+    helper.send_message(sock, message, framed)
 
 
 def accept_client(listen_sock: socket) -> Optional[socket]:
@@ -86,69 +432,145 @@ def accept_client(listen_sock: socket) -> Optional[socket]:
     """
     try:
         client_sock, client_addr = listen_sock.accept()
-        print('Connected to {}'.format(client_addr))
-        send(client_sock, checksum=False, data=WELCOME)
+        client_sock.setblocking(True)
+        print('Connected to {}'.format(client_addr or 'unix socket'))
         return client_sock
 
-    except SocketError:
-        if client_sock is not None:
-            client_sock.close()
+    except BlockingIOError:
+        #   Another worker process accepted the client
+        return None
 
+    except SocketError:
+        print('Something went wrong with connecting to a client')
         return None
 
 
-def get_user(sock: socket) -> Optional[str]:
+def reject_client(sock: socket, limits: Limits) -> None:
+    """ Tells a client the server is too busy to serve it, and disconnects. """
+    with sock:
+        try:
+            sock.settimeout(limits.read_timeout)
+            send(sock, checksum=False, error=BUSY)
+        except SocketError:
+            pass
+
+
+def get_user(sock: socket,
+             login_pool: login.LoginPool,
+             limits: Limits) -> Optional[Session]:
+    """ Receives the login message of the client and verifies it.
+    :param sock: The socket with the client.
+    :param login_pool: Where the login is verified.
+    :param limits: Bounds on the work the server takes.
+    :return: The session of the client. None if it could not log in.
+    """
     try:
-        login_request = recieve(sock)
+        login_request = recieve(sock, timeout=limits.read_timeout)
         username = login_request['username']
         password = login_request['password']
+        new_user = 'new_user' in login_request
+        #   The reply to the login is the first message in the protocol the
+        #   client asked for
+        framed = helper.uses_framed_protocol(login_request)
+
+        if new_user and username in ADMIN_USERNAMES:
+            #   Admins are known by name only, so the first to sign up with
+            #   the name of an admin must not become one
+            send(sock, framed=framed,
+                 error='The username {} is reserved'.format(username))
+            return None
 
-        login_func = (data.add_new_user
-                      if 'new_user' in login_request else
-                      data.password_matchs_username)
-        login_successful = login_func(PASSWORD_FILE_PATH, username, password)
+        login_successful = login_pool.login(username, password, new_user,
+                                            limits.read_timeout)
+        summary = login_pool.stats.periodic_summary()
+        if summary is not None:
+            print(summary)
 
-        if login_successful:
+        if login_successful is None:
+            send(sock, False, framed, error=BUSY)
+            return None
+        elif login_successful:
             print('User successfuly logged in!')
-            send(sock, login_successful='')
-            return username
+            send(sock, framed=framed, login_successful='')
+            return Session(username, DEFAULT_CATALOG_NAME, framed)
         else:
-            send(sock, error='Invalid username or password')
+            send(sock, framed=framed, error='Invalid username or password')
             return None
+    except (helper.Error, KeyError):
+        try:
+            send(sock, False, error='Expected a login message')
+        except SocketError:
+            pass
+        return None
     except SocketError:
         return None
 
 
-def do_request_response(sock: socket, dataset: data.Dataset) -> bool:
+def do_request_response(sock: socket,
+                        store: CatalogStore,
+                        session: Session,
+                        limits: Limits) -> bool:
     """ Will respond to the next request from the client.
     :param sock: The connection to the client.
-    :param dataset: The dataset the server uses.
+    :param store: The catalogs the server serves.
+    :param session: The client's session. A request with a catalog field
+                    is answered from that catalog instead of the session's.
+    :param limits: Bounds on the work the server takes.
     :return: True if succesful, False if client disconnected.
     """
     try:
-        request = recieve(sock)
+        request = recieve(sock, session.framed, limits.read_timeout,
+                          limits.idle_timeout)
+        CAPTURE.record(session.id, request)
 
         if 'code' not in request or 'data' not in request:
             raise helper.Error('Message need a code '
                                'field and a data field!')
 
+        if not request['code'].isdigit():
+            raise helper.Error('The code field must be a number')
         req_code = int(request['code'])
         req_data = request['data']
 
-        resposne_data = get_response_data(dataset, req_code, req_data)
-        send(sock, data=resposne_data)
+        if req_code in (USE_CATALOG_CODE, LIST_CATALOGS_CODE):
+            response = dict(data=answer_catalogs_request(store, session,
+                                                         req_code, req_data))
+        elif req_code in ADMIN_RESPONSES:
+            check_change_request(request)
+            catalog = get_catalog(store, request.get('catalog',
+                                                     session.catalog_name))
+            response = dict(data=change_catalog(catalog, session.username,
+                                                req_code, req_data))
+        else:
+            catalog = get_catalog(store, request.get('catalog',
+                                                     session.catalog_name))
+            #   Responses to queries carry the version of the catalog, so
+            #   the client can cache them and later send the version back
+            cacheable = (req_code in RESPONSES and
+                         not helper.is_exit_request_code(req_code))
+            with catalog.lock:
+                catalog.sync()
+                version = catalog.version
+                if cacheable and request.get('version') == version:
+                    response = dict(not_modified='')
+                else:
+                    response = dict(data=get_response_data(
+                        catalog.dataset, req_code, req_data))
+            if cacheable:
+                response['version'] = version
+        send(sock, framed=session.framed, **response)
 
         if helper.is_exit_request_code(req_code):
             return False
 
     except helper.ChecksumError as e:
-        send(sock, False,
+        send(sock, False, session.framed,
              error='checksumerror',
              actual=e.actual_checksum,
              expected=e.expected_checksum)
 
     except helper.Error as e:
-        send(sock, False, error=str(e))
+        send(sock, False, session.framed, error=str(e))
 
     except SocketError:
         return False
@@ -156,39 +578,307 @@ def do_request_response(sock: socket, dataset: data.Dataset) -> bool:
     return True
 
 
-def serve_client(sock: socket, dataset: data.Dataset) -> None:
+def serve_client(sock: socket,
+                 store: CatalogStore,
+                 session: Session,
+                 limits: Limits) -> None:
     """ Answers all the requests from the client until disconnect.
-        To be called after accepting a client (accept_client(sock)).
+        To be called after the client logged in (get_user(sock)).
     :param sock: A socket connected to client. Will be closed afterwards!
-    :param dataset: The dataset the server uses.
+    :param store: The catalogs the server serves.
+    :param session: The client's session.
+    :param limits: Bounds on the work the server takes.
     """
     with sock:
         stay_connected = True
         while stay_connected:
-            stay_connected = do_request_response(sock, dataset)
+            stay_connected = do_request_response(sock, store, session,
+                                                 limits)
         print('Client disconnected!')
 
 
-def main():
+def serve_session(sock: socket,
+                  store: CatalogStore,
+                  login_pool: login.LoginPool,
+                  limits: Limits) -> None:
+    """ Welcomes an accepted client, logs it in and answers its requests
+        until it disconnects.
+    """
+    sock.settimeout(limits.read_timeout)
+    try:
+        send(sock, checksum=False, data=WELCOME,
+             protocol=helper.FRAMED_PROTOCOL)
+    except SocketError:
+        sock.close()
+        return
+
+    session = get_user(sock, login_pool, limits)
+
+    if session is None:
+        print('User could not log in')
+        sock.close()
+    else:
+        serve_client(sock, store, session, limits)
 
-    with open(DATASET_FILE_PATH, 'r') as file:
-        text = file.read()
-        dataset = data.parse_dataset(text)
 
-    with get_listen_socket() as listen_sock:
-        print('Server listening')
+def run_sessions(clients: queue.Queue,
+                 store: CatalogStore,
+                 login_pool: login.LoginPool,
+                 limits: Limits) -> None:
+    """ Serves clients from the queue, one after the other. Runs in each of
+        the session threads.
+    """
+    while True:
+        client_sock = clients.get()
+        try:
+            serve_session(client_sock, store, login_pool, limits)
+        except Exception:
+            traceback.print_exc()
+            client_sock.close()
+
+
+def serve_forever(listen_socks: List[socket],
+                  store: CatalogStore,
+                  limits: Limits) -> None:
+    """ Accepts clients and serves them in limits.max_sessions threads.
+        Clients that arrive when all the threads are busy wait in a queue,
+        and if the queue is full they are told the server is busy.
+    :param listen_socks: The sockets to accept clients from.
+    :param store: The catalogs the server serves.
+    :param limits: Bounds on the work the server takes.
+    """
+    login_pool = login.LoginPool(PASSWORD_FILE_PATH,
+                                 limits.login_workers,
+                                 limits.login_queue_size)
+    clients = queue.Queue(limits.queue_size)
+    for _ in range(limits.max_sessions):
+        threading.Thread(target=run_sessions,
+                         args=(clients, store, login_pool, limits),
+                         daemon=True).start()
+
+    with selectors.DefaultSelector() as selector:
+        for listen_sock in listen_socks:
+            #   Other worker processes may accept the client first
+            listen_sock.setblocking(False)
+            selector.register(listen_sock, selectors.EVENT_READ)
+
         while True:
-            client_sock = accept_client(listen_sock)
+            for key, _ in selector.select():
+                client_sock = accept_client(key.fileobj)
+                if client_sock is None:
+                    continue
+
+                try:
+                    clients.put_nowait(client_sock)
+                except queue.Full:
+                    print('Too many clients, rejecting a client')
+                    reject_client(client_sock, limits)
+
+
+def start_worker(store: CatalogStore,
+                 limits: Limits,
+                 address: Tuple[str, int],
+                 shared_socks: List[socket],
+                 capture_path: Optional[str]) -> int:
+    """ Forks a worker process that listens with SO_REUSEPORT and serves
+        clients. The catalogs the parent loaded are shared with it (copy on
+        write).
+    :param address: The TCP address all the workers listen on.
+    :param shared_socks: Listening sockets opened by the parent, that all
+                         the workers accept clients from (unix sockets
+                         do not support SO_REUSEPORT).
+    :param capture_path: Record the requests to this path with the pid of
+                         the worker added, or None.
+    :return: The pid of the worker.
+    """
+    pid = os.fork()
+    if pid != 0:
+        return pid
 
-            if client_sock is None:
-                print('Something went wrong with connecting to a client')
-            else:
-                username = get_user(client_sock)
+    #   SIGTERM stops workers like ctrl+c, with the handler set in main, so
+    #   the capture is flushed before they exit
+    exit_code = 0
+    try:
+        if capture_path is not None:
+            CAPTURE.open('{}.{}'.format(capture_path, os.getpid()))
+        with get_listen_socket(address, reuse_port=True) as listen_sock:
+            print('Worker {} listening'.format(os.getpid()))
+            serve_forever([listen_sock] + shared_socks, store, limits)
+    except KeyboardInterrupt:
+        pass
+    except BaseException:
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        CAPTURE.close()
+        os._exit(exit_code)
+
+
+def supervise_workers(store: CatalogStore,
+                      limits: Limits,
+                      worker_count: int,
+                      address: Tuple[str, int],
+                      shared_socks: List[socket],
+                      capture_path: Optional[str]) -> None:
+    """ Runs worker_count worker processes and replaces workers that exit.
+    :param store: Catalogs loaded before forking are shared by the workers.
+    :param limits: The limits of every worker.
+    :param worker_count: The number of worker processes.
+    :param address: The TCP address to pass to start_worker.
+    :param shared_socks: Listening sockets to pass to start_worker.
+    :param capture_path: To pass to start_worker.
+    """
+    #   Objects that exist before the fork are never collected, so the
+    #   collector does not write to (and copy) the pages of the dataset
+    gc.freeze()
 
-                if username is None:
-                    print('User could not log in')
-                else:
-                    serve_client(client_sock, dataset)
+    workers = {start_worker(store, limits, address, shared_socks,
+                                 capture_path)
+               for _ in range(worker_count)}
+    try:
+        while True:
+            pid, status = os.wait()
+            workers.discard(pid)
+            print('Worker {} exited with status {}, restarting it'
+                  .format(pid, status))
+            time.sleep(WORKER_RESTART_DELAY)
+            workers.add(start_worker(store, limits, address, shared_socks,
+                                 capture_path))
+    except KeyboardInterrupt:
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+        for pid in workers:
+            os.waitpid(pid, 0)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='The pink floyd server')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes. With more than '
+                             'one, every worker listens with SO_REUSEPORT')
+    parser.add_argument('--port', type=int, default=helper.SERVER_PORT,
+                        help='The TCP port to listen on')
+    parser.add_argument('--unix', nargs='?', const=helper.SERVER_UNIX_PATH,
+                        metavar='PATH',
+                        help='Also listen on a unix domain socket '
+                             '(default path {})'
+                             .format(helper.SERVER_UNIX_PATH))
+    parser.add_argument('--dataset', default=DATASET_FILE_PATH,
+                        metavar='PATH',
+                        help='The dataset file of the default catalog, '
+                             '"{}"'.format(DEFAULT_CATALOG_NAME))
+    parser.add_argument('--catalogs', metavar='DIR',
+                        help='Also serve every {0} file in this directory '
+                             'as a catalog, named after the file '
+                             '(The_Wall{0} is "the wall")'
+                             .format(CATALOG_FILE_EXTENSION))
+    parser.add_argument('--memory-budget', type=float, default=MEMORY_BUDGET,
+                        metavar='MB',
+                        help='Megabytes the loaded catalogs may take (per '
+                             'worker), the least recently used are '
+                             'unloaded')
+    parser.add_argument('--parse-processes', type=int, default=1,
+                        help='Parse catalogs in this many processes, for '
+                             'large catalogs on machines with many cores')
+    parser.add_argument('--capture', metavar='PATH',
+                        help='Record the requests to this file, for '
+                             'replay.py (with --workers, one file per '
+                             'worker, named PATH.<pid>)')
+    parser.add_argument('--admin', action='append', default=[],
+                        metavar='USERNAME',
+                        help='A user that may change the catalog '
+                             '(can be given more than once). The user must '
+                             'have signed up already, as admins can not '
+                             'sign up')
+    parser.add_argument('--max-sessions', type=int, default=MAX_SESSIONS,
+                        help='Clients served at the same time (per worker)')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                        help='Clients that may wait for a session before '
+                             'new clients are told the server is busy')
+    parser.add_argument('--login-workers', type=int, default=LOGIN_WORKERS,
+                        help='Logins verified at the same time (per worker)')
+    parser.add_argument('--login-queue-size', type=int,
+                        default=LOGIN_QUEUE_SIZE,
+                        help='Logins that may wait to be verified before '
+                             'new logins are told the server is busy')
+    parser.add_argument('--read-timeout', type=float, default=READ_TIMEOUT,
+                        help='Seconds a client has to log in, and to send '
+                             'the rest of a request it started')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='Seconds a client may wait between requests')
+    args = parser.parse_args()
+    if args.unix is not None and helper.AF_UNIX is None:
+        parser.error(helper.UNIX_UNSUPPORTED)
+    if args.workers > 1 and (SO_REUSEPORT is None or
+                             not hasattr(os, 'fork')):
+        parser.error('--workers is not supported on this system')
+    #   A queue of size 0 would have no bound, and a timeout of 0 would make
+    #   the sockets non-blocking
+    for option in ('max_sessions', 'queue_size', 'login_workers',
+                   'login_queue_size', 'read_timeout', 'idle_timeout'):
+        if getattr(args, option) <= 0:
+            parser.error('--{} must be positive'
+                         .format(option.replace('_', '-')))
+    return args
+
+
+def find_catalogs(directory: str) -> Dict[str, str]:
+    """ The dataset files in a directory, by catalog name. """
+    return {os.path.splitext(file_name)[0].replace('_', ' ').lower():
+            os.path.join(directory, file_name)
+            for file_name in os.listdir(directory)
+            if file_name.endswith(CATALOG_FILE_EXTENSION)}
+
+
+def main():
+    args = parse_args()
+
+    ADMIN_USERNAMES.update(args.admin)
+    logins = data.read_logins(PASSWORD_FILE_PATH)
+    for username in sorted(ADMIN_USERNAMES.difference(logins)):
+        print('The admin {} has no account, and can not sign up while they '
+              'are an admin'.format(username))
+    dataset_paths = {}
+    if args.catalogs is not None:
+        dataset_paths.update(find_catalogs(args.catalogs))
+    dataset_paths[DEFAULT_CATALOG_NAME] = args.dataset
+    store = CatalogStore(dataset_paths, int(args.memory_budget * 2 ** 20),
+                         args.parse_processes)
+    #   Load the default catalog before forking, so the workers share it
+    store.get(DEFAULT_CATALOG_NAME)
+
+    limits = Limits(max_sessions=args.max_sessions,
+                    queue_size=args.queue_size,
+                    login_workers=args.login_workers,
+                    login_queue_size=args.login_queue_size,
+                    read_timeout=args.read_timeout,
+                    idle_timeout=args.idle_timeout)
+
+    address = helper.SERVER_IP, args.port
+    unix_socks = []
+    if args.unix is not None:
+        unix_socks.append(get_unix_listen_socket(args.unix))
+        print('Listening on {}'.format(args.unix))
+
+    #   Stop the same way on SIGTERM as on ctrl+c, to clean up
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        if args.workers > 1:
+            supervise_workers(store, limits, args.workers, address,
+                              unix_socks, args.capture)
+        else:
+            if args.capture is not None:
+                CAPTURE.open(args.capture)
+            with get_listen_socket(address) as listen_sock:
+                print('Server listening')
+                serve_forever([listen_sock] + unix_socks, store, limits)
+    except KeyboardInterrupt:
+        print('Server stopped')
+    finally:
+        CAPTURE.close()
+        for unix_sock in unix_socks:
+            os.remove(unix_sock.getsockname())
+            unix_sock.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,14 @@
+""" Tests of benchmark.py, run with python -m pytest. """
+import benchmark
+import generate_dataset
+
+
+def test_benchmark_scale_runs_every_query():
+    #   A small catalog, the vocabulary has the query operators as words
+    vocabulary = generate_dataset.load_vocabulary()
+    assert {'and', 'or', 'not'} & {word.lower() for word in vocabulary.words}
+    result = benchmark.benchmark_scale(200, vocabulary, 20, 4)
+    assert result['songs'] == 200
+    assert result['queries'].keys() == benchmark.QUERIES.keys()
+    for latency in result['queries'].values():
+        assert 0 <= latency['median_us'] <= latency['max_us']
@@ -0,0 +1,236 @@
+""" Tests of data.py, run with python -m pytest. """
+import io
+import os
+import random
+
+import pytest
+
+import data
+import generate_dataset
+
+DATASET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'Pink_Floyd_DB.txt')
+
+#   Text before the first album, a song that appears twice and an album
+#   without songs
+ODD_DATASET_TEXT = ('junk before#A::1\n'
+                    '*s::a::01:00::x y\n'
+                    '*s::a::01:00::x y\n'
+                    '#B::2\n'
+                    '*t::b::02:00::z\n'
+                    '#C\n')
+
+
+@pytest.fixture(scope='module')
+def dataset_text() -> str:
+    with open(DATASET_PATH, 'r') as file:
+        return file.read()
+
+
+@pytest.fixture(scope='module')
+def synthetic_text() -> str:
+    """ A generated dataset, with many more albums than chunks. """
+    file = io.StringIO()
+    generate_dataset.write_dataset(
+        file, 2000, generate_dataset.load_vocabulary(DATASET_PATH))
+    return file.getvalue()
+
+
+def assert_same_dataset(actual: data.Dataset,
+                        expected: data.Dataset) -> None:
+    """ Compares every field of the datasets, and the order of the albums
+        and the songs, which comparing dicts ignores.
+    """
+    for field in data.Dataset._fields:
+        assert getattr(actual, field) == getattr(expected, field), field
+    assert list(actual.albums.items()) == list(expected.albums.items())
+    assert list(actual.songs) == list(expected.songs)
+
+
+@pytest.mark.parametrize('processes', [2, 3, 7])
+def test_parallel_parse_matches_serial(dataset_text, synthetic_text,
+                                       processes):
+    for text in (dataset_text, synthetic_text, ODD_DATASET_TEXT):
+        assert_same_dataset(data.parse_dataset(text, processes),
+                            data.parse_dataset(text))
+
+
+def test_parallel_parse_of_few_albums(dataset_text):
+    #   More processes than albums
+    text = '#'.join(dataset_text.split('#')[:3])
+    assert_same_dataset(data.parse_dataset(text, 7),
+                        data.parse_dataset(text))
+
+
+QUERY_DATASET_TEXT = ('#First::1\n'
+                      '*one::a::01:00::Money for nothing\n'
+                      'and the time is free\n'
+                      '*two::a::02:00::Time is money\n'
+                      '#Second::2\n'
+                      '*three::b::03:00::The dark side\n'
+                      'of the moon\n'
+                      '*four::b::04:00::Not a word of money\n')
+
+
+@pytest.fixture(scope='module')
+def query_dataset() -> data.Dataset:
+    return data.parse_dataset(QUERY_DATASET_TEXT)
+
+
+def test_query_parser_precedence():
+    def phrase(*words):
+        return data.QueryNode('phrase', list(words))
+
+    assert data.QueryParser('a b or not "c d"').parse() == data.QueryNode(
+        'or', [data.QueryNode('and', [phrase('a'), phrase('b')]),
+               data.QueryNode('not', [phrase('c', 'd')])])
+    assert data.QueryParser('a and (b or c)').parse() == data.QueryNode(
+        'and', [phrase('a'),
+                data.QueryNode('or', [phrase('b'), phrase('c')])])
+
+
+@pytest.mark.parametrize('query, songs', [
+    ('money', ['four', 'one', 'two']),
+    ('MONEY', ['four', 'one', 'two']),
+    ('money and time', ['one', 'two']),
+    ('money time', ['one', 'two']),
+    ('money or moon', ['four', 'one', 'three', 'two']),
+    ('time and not "time is money"', ['one']),
+    ('(money or moon) and not time', ['four', 'three']),
+    ('missing', []),
+    #   Only negated words
+    ('not money', ['three']),
+    ('not not money', ['four', 'one', 'two']),
+    ('not money and not moon', []),
+    ('not (money and time)', ['four', 'three']),
+    #   Phrases, across lines too
+    ('"is money"', ['two']),
+    ('"money is"', []),
+    ('"nothing and the time"', ['one']),
+    ('"dark side of the moon"', ['three']),
+    ('"not"', ['four']),
+])
+def test_search_lyrics_query(query_dataset, query, songs):
+    assert data.search_lyrics_query(query_dataset, query) == songs
+
+
+@pytest.mark.parametrize('query', [
+    '', 'and', 'or money', 'money and', 'money or', 'not', '(money',
+    'money)', '()', '"money', '""', '!!!',
+])
+def test_malformed_lyrics_query(query_dataset, query):
+    with pytest.raises(data.QueryError):
+        data.search_lyrics_query(query_dataset, query)
+
+
+def test_phrases_across_lines(dataset_text):
+    dataset = data.parse_dataset(dataset_text)
+    for song_name, song_info in dataset.songs.items():
+        first_line, _, rest = song_info.lyrics.partition('\n')
+        last_words = data.split_words(first_line)[-2:]
+        next_words = data.split_words(rest)[:2]
+        if not last_words or not next_words:
+            continue
+        query = '"{}"'.format(' '.join(last_words + next_words))
+        assert song_name in data.search_lyrics_query(dataset, query), query
+
+
+def assert_indexes_match_rebuild(dataset: data.Dataset) -> None:
+    """ Checks the indexes of a changed dataset against indexes built
+        again from its songs and albums.
+    """
+    rebuilt = data.make_dataset(
+        dict(dataset.songs),
+        {album: list(song_names)
+         for album, song_names in dataset.albums.items()})
+    assert dataset.song_names == rebuilt.song_names
+    assert dataset.album_names == rebuilt.album_names
+    assert dataset.lengths == rebuilt.lengths
+    assert dataset.word_counts == rebuilt.word_counts
+    assert dataset.word_positions == rebuilt.word_positions
+    assert dataset.lyrics_index.vectors == rebuilt.lyrics_index.vectors
+    assert dataset.lyrics_index.postings == rebuilt.lyrics_index.postings
+    for song_name in dataset.songs:
+        assert (data.get_vector_norm(dataset.lyrics_index, song_name) ==
+                pytest.approx(rebuilt.lyrics_index.norms[song_name]))
+
+    assert dataset.album_stats.keys() == rebuilt.album_stats.keys()
+    for album, stats in dataset.album_stats.items():
+        rebuilt_stats = rebuilt.album_stats[album]
+        assert stats.track_count == rebuilt_stats.track_count
+        assert stats.word_counts == rebuilt_stats.word_counts
+        #   Sums of the lengths in another order
+        assert stats.total_time == pytest.approx(rebuilt_stats.total_time)
+
+
+def test_changes_keep_indexes(dataset_text):
+    dataset = data.parse_dataset(dataset_text)
+    #   Cache some results, which the changes must drop
+    data.get_similar_songs(dataset, 3, 'money')
+    money_time = dataset.songs['money'].time
+    changes = [
+        dict(action='add_album', album='new album'),
+        dict(action='add_song', album='new album', name='a new song',
+             time=money_time, lyrics='money money\nthe new song'),
+        dict(action='add_song', album='new album', name='zz new song',
+             time=money_time, lyrics='new'),
+        dict(action='update_song', album='new album', name='money',
+             time=1.5, lyrics='dogs and pigs'),
+        dict(action='update_song', album='animals', name='dogs',
+             time=money_time, lyrics='dogs'),
+        dict(action='remove_song', name='time'),
+        dict(action='rename_album', album='the wall', new_name='wall'),
+        dict(action='remove_album', album='more'),
+    ]
+    for change in changes:
+        data.apply_change(dataset, change)
+        assert_indexes_match_rebuild(dataset)
+    assert (data.get_similar_songs(dataset, 3, 'a new song') ==
+            data.get_similar_songs(data.make_dataset(
+                dict(dataset.songs), dict(dataset.albums)),
+                3, 'a new song'))
+
+
+@pytest.mark.parametrize('change', [
+    dict(action='add_song', album='animals', name='money', time=1,
+         lyrics=''),
+    dict(action='add_song', album='missing', name='new', time=1, lyrics=''),
+    dict(action='update_song', album='animals', name='missing', time=1,
+         lyrics=''),
+    dict(action='remove_song', name='missing'),
+    dict(action='add_album', album='animals'),
+    dict(action='rename_album', album='missing', new_name='new'),
+    dict(action='rename_album', album='animals', new_name='the wall'),
+    dict(action='remove_album', album='missing'),
+    dict(action='unknown'),
+])
+def test_failed_change_keeps_dataset(dataset_text, change):
+    dataset = data.parse_dataset(dataset_text)
+    with pytest.raises(data.ChangeError):
+        data.apply_change(dataset, change)
+    assert_same_dataset(dataset, data.parse_dataset(dataset_text))
+
+
+def test_random_changes_keep_indexes(synthetic_text):
+    dataset = data.parse_dataset(synthetic_text)
+    rand = random.Random(0)
+    for index in range(300):
+        song_name = rand.choice(dataset.song_names)
+        album = rand.choice(dataset.album_names)
+        #   Few lengths, so many songs have the same length
+        time = rand.randint(1, 5)
+        lyrics = ' '.join(rand.choices(['a', 'b', 'c', 'money'], k=5))
+        change = rand.choice([
+            dict(action='add_song', album=album,
+                 name='song {}'.format(index), time=time, lyrics=lyrics),
+            dict(action='update_song', album=album, name=song_name,
+                 time=time, lyrics=lyrics),
+            dict(action='remove_song', name=song_name),
+            dict(action='add_album', album='album {}'.format(index)),
+            dict(action='rename_album', album=album,
+                 new_name='renamed {}'.format(index)),
+        ])
+        data.apply_change(dataset, change)
+    album = dataset.album_names[0]
+    data.apply_change(dataset, dict(action='remove_album', album=album))
+    assert_indexes_match_rebuild(dataset)
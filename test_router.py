@@ -0,0 +1,198 @@
+""" Tests of router.py, run with python -m pytest. """
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set
+
+import pytest
+
+import data
+import helper
+import router
+import server
+
+DATASET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'Pink_Floyd_DB.txt')
+SHARD_COUNT = 3
+
+
+class FakeShardSession(router.ShardSession):
+    """ Shards answered from datasets in this process, as their servers
+        would answer the router.
+    """
+
+    def __init__(self, datasets, executor: ThreadPoolExecutor):
+        super().__init__([None] * len(datasets), executor, timeout=1)
+        self.datasets = datasets
+        #   Shard number -> request codes the shard fails, as if it became
+        #   unavailable
+        self.failing_codes: Dict[int, Set[int]] = dict()
+        self.codes_received = []
+
+    def request(self, index: int, fields: Dict[str, str]) -> Dict[str, str]:
+        req_code = int(fields['code'])
+        self.codes_received.append(req_code)
+        if req_code in self.failing_codes.get(index, ()):
+            raise helper.Error('Shard {} is unavailable'.format(index))
+
+        dataset = self.datasets[index]
+        try:
+            if req_code in server.ADMIN_RESPONSES:
+                try:
+                    data.apply_change(dataset, server.ADMIN_RESPONSES[
+                        req_code](fields['data']))
+                except data.ChangeError as e:
+                    raise helper.Error(str(e))
+                response = dict(data='Done')
+            else:
+                response = dict(data=server.get_response_data(
+                    dataset, req_code, fields['data']))
+        except helper.Error as e:
+            response = dict(error=str(e))
+        #   Fields as they arrive, lowercase
+        return helper.parse_message(helper.make_message_no_checksum(
+            **response))
+
+
+@pytest.fixture(scope='module')
+def dataset_text() -> str:
+    with open(DATASET_PATH, 'r') as file:
+        return file.read()
+
+
+@pytest.fixture
+def shards(dataset_text) -> FakeShardSession:
+    with ThreadPoolExecutor(SHARD_COUNT) as executor:
+        yield FakeShardSession(
+            [data.parse_dataset(shard_text) for shard_text
+             in router.split_dataset(dataset_text, SHARD_COUNT)],
+            executor)
+
+
+def make_request(req_code: int, req_data: str) -> Dict[str, str]:
+    """ A request as the router receives it, with a checksum. """
+    return helper.parse_message(helper.make_message(code=req_code,
+                                                    data=req_data))
+
+
+def test_merge_lists():
+    empty, not_found = server.EMPTY_LIST.lower(), server.NOT_FOUND.lower()
+    assert router.merge_lists(['a\nb', 'b\nc', 'a']) == 'a\nb\nc'
+    assert router.merge_lists(['a', not_found, empty]) == 'a'
+    assert router.merge_lists([empty, not_found]) == server.EMPTY_LIST
+    assert router.merge_lists([not_found, not_found]) == server.NOT_FOUND
+
+
+def test_merge_completions():
+    names = ['name {:02}'.format(index) for index in range(15)]
+    datas = ['\n'.join(names[1::2]), '\n'.join(names[::2]),
+             server.EMPTY_LIST.lower()]
+    assert (router.merge_completions(datas) ==
+            '\n'.join(names[:router.COMPLETE_LIMIT]))
+    assert (router.merge_completions([server.EMPTY_LIST.lower()] * 2) ==
+            server.EMPTY_LIST)
+
+
+def test_merge_by_length():
+    empty, not_found = server.EMPTY_LIST.lower(), server.NOT_FOUND.lower()
+    datas = ['01:00::b\n03:00::d', empty, '01:00::a\n02:00::c\n10:05::e']
+    assert router.merge_by_length(datas) == 'a\nb\nc\nd\ne'
+    assert router.merge_by_length([empty, not_found]) == server.EMPTY_LIST
+    assert router.merge_by_length([not_found] * 2) == server.NOT_FOUND
+
+
+@pytest.mark.parametrize('req_code, req_data', [
+    (1, ''),
+    (3, 'money'),
+    (9, 't'),
+    (10, 't'),
+    (11, '4,6'),
+    (11, '4,6,animals'),
+    (11, '4,6,missing'),
+    (11, '30,40'),
+])
+def test_route_matches_one_server(dataset_text, shards, req_code, req_data):
+    expected = server.get_response_data(data.parse_dataset(dataset_text),
+                                        req_code, req_data)
+    response = router.route(shards, make_request(req_code, req_data))
+    assert response['data'].lower() == expected.lower()
+
+
+@pytest.mark.parametrize('req_code, req_data', [
+    (2, 'the wall'),
+    (6, 'the'),
+    (7, 'love'),
+    (25, 'money or time'),
+])
+def test_route_merges_all_songs(dataset_text, shards, req_code, req_data):
+    expected = server.get_response_data(data.parse_dataset(dataset_text),
+                                        req_code, req_data)
+    response = router.route(shards, make_request(req_code, req_data))
+    #   In the order of the shards
+    assert (sorted(response['data'].split('\n')) ==
+            sorted(expected.split('\n')))
+
+
+def test_length_search_asks_for_times(shards):
+    router.route(shards, make_request(router.LENGTH_SEARCH_CODE, '4,6'))
+    assert shards.codes_received == ([server.TIMED_LENGTH_SEARCH_CODE] *
+                                     SHARD_COUNT)
+
+
+def album_songs(shards: FakeShardSession,
+                album: str) -> List[Optional[List[str]]]:
+    """ The songs of an album in every shard, None where it is missing. """
+    return [dataset.albums.get(album) for dataset in shards.datasets]
+
+
+def test_album_changes_apply_to_every_shard(shards):
+    wall_songs = album_songs(shards, 'the wall')
+    router.route(shards, make_request(router.ADD_ALBUM_CODE, 'new album'))
+    assert album_songs(shards, 'new album') == [[]] * SHARD_COUNT
+
+    router.route(shards, make_request(router.RENAME_ALBUM_CODE,
+                                      'the wall::wall'))
+    assert album_songs(shards, 'wall') == wall_songs
+    assert album_songs(shards, 'the wall') == [None] * SHARD_COUNT
+
+    router.route(shards, make_request(router.REMOVE_ALBUM_CODE, 'wall'))
+    assert album_songs(shards, 'wall') == [None] * SHARD_COUNT
+
+
+@pytest.mark.parametrize('req_code, req_data', [
+    (router.ADD_ALBUM_CODE, 'diverged'),
+    (router.RENAME_ALBUM_CODE, 'the wall::diverged'),
+    (router.RENAME_ALBUM_CODE, 'missing::new name'),
+    (router.REMOVE_ALBUM_CODE, 'missing'),
+])
+def test_album_change_checked_on_every_shard(shards, req_code, req_data):
+    #   Only the last shard has the album, so the others would accept it
+    data.apply_change(shards.datasets[-1],
+                      dict(action='add_album', album='diverged'))
+    albums = [list(dataset.albums) for dataset in shards.datasets]
+    with pytest.raises(helper.Error):
+        router.route(shards, make_request(req_code, req_data))
+    assert [list(dataset.albums) for dataset in shards.datasets] == albums
+    #   Only the checks were sent
+    assert router.SONGS_IN_ALBUM_CODE in shards.codes_received
+    assert req_code not in shards.codes_received
+
+
+@pytest.mark.parametrize('req_code, req_data', [
+    (router.ADD_ALBUM_CODE, 'new album'),
+    (router.RENAME_ALBUM_CODE, 'the wall::wall'),
+])
+def test_failed_album_change_is_undone(shards, req_code, req_data):
+    albums = [dict(dataset.albums) for dataset in shards.datasets]
+    shards.failing_codes[SHARD_COUNT - 1] = {req_code}
+    response = router.route(shards, make_request(req_code, req_data))
+    assert 'unavailable' in response['error']
+    #   A renamed album moves to the end, even when renamed back
+    assert [dict(dataset.albums) for dataset in shards.datasets] == albums
+
+
+def test_failed_album_removal_reports_changed_shards(shards):
+    shards.failing_codes[1] = {router.REMOVE_ALBUM_CODE}
+    with pytest.raises(helper.Error, match='stays applied to shards 0, 2'):
+        router.route(shards, make_request(router.REMOVE_ALBUM_CODE,
+                                          'the wall'))
+    assert album_songs(shards, 'the wall')[::2] == [None, None]